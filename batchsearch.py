@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+"""
+This module provides a front end for SimSearch which combines queries that
+arrive at about the same time into batches.
+"""
+
+import threading
+import time
+from Queue import Queue, Empty
+
+
+class QueryFuture(object):
+    """
+    The pending result of a query submitted to a BatchSearch. Call `result`
+    to wait for the results.
+    """
+    def __init__(self, text, topn):
+        self.text = text
+        self.topn = topn
+        self.submit_time = time.time()
+
+        self.done = threading.Event()
+        self.results = None
+        self.error = None
+
+    def setResults(self, results):
+        self.results = results
+        self.done.set()
+
+    def setError(self, error):
+        self.error = error
+        self.done.set()
+
+    def result(self, timeout=None):
+        """
+        Wait for the query to finish, and return the results as a list of
+        tuples in the form:
+            (doc_id, similarity_value)
+        """
+        if not self.done.wait(timeout):
+            raise RuntimeError('Timed out waiting for query results.')
+
+        if self.error is not None:
+            raise self.error
+
+        return self.results
+
+
+class BatchSearch(object):
+    """
+    BatchSearch collects text queries from any number of caller threads, and
+    runs them through SimSearch in batches on a single worker thread.
+
+    When a query arrives, the worker waits up to `max_latency_ms` for more
+    queries to arrive (or until it has `max_batch_size` queries), then:
+        1. Converts all of the query texts to tf-idf vectors.
+        2. Projects them onto the LSI space as one batch.
+        3. Compares them all to the index with a single matrix multiply.
+        4. Hands each caller its own top N results.
+
+    Under heavy load this makes much better use of BLAS than scoring the
+    queries one at a time, at the cost of up to `max_latency_ms` of extra
+    latency per query.
+
+    Usage:
+        bsearch = BatchSearch(ssearch)
+        results = bsearch.search('some query text', topn=10)
+        bsearch.close()
+    """
+    def __init__(self, ssearch, max_batch_size=64, max_latency_ms=5.0):
+        self.ssearch = ssearch
+        self.max_batch_size = max_batch_size
+        self.max_latency_ms = max_latency_ms
+
+        # Counters for the number of batches and queries processed.
+        self.num_batches = 0
+        self.num_queries = 0
+
+        self.queue = Queue()
+
+        # Start the worker thread.
+        self.running = True
+        self.worker = threading.Thread(target=self.runWorker)
+        self.worker.daemon = True
+        self.worker.start()
+
+    def submit(self, text, topn=10):
+        """
+        Submit a query without waiting for it. Returns a QueryFuture.
+        """
+        future = QueryFuture(text, topn)
+        self.queue.put(future)
+        return future
+
+    def search(self, text, topn=10):
+        """
+        Find documents similar to `text`, the same as
+        `SimSearch.findSimilarToText`, but batched with any other queries
+        that arrive at the same time.
+        """
+        return self.submit(text, topn).result()
+
+    def close(self):
+        """
+        Stop the worker thread, after it finishes any queued queries.
+        """
+        self.running = False
+        self.worker.join()
+
+    def getBatch(self):
+        """
+        Wait for the next query, then gather any others which arrive within
+        the latency window, up to the maximum batch size.
+        """
+        try:
+            batch = [self.queue.get(timeout=0.1)]
+        except Empty:
+            return []
+
+        deadline = batch[0].submit_time + self.max_latency_ms / 1000.0
+
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.time()
+
+            try:
+                if remaining > 0:
+                    batch.append(self.queue.get(timeout=remaining))
+                else:
+                    batch.append(self.queue.get_nowait())
+            except Empty:
+                break
+
+        return batch
+
+    def runWorker(self):
+        """
+        The worker thread: process batches of queries until closed.
+        """
+        while self.running or not self.queue.empty():
+            batch = self.getBatch()
+
+            if not batch:
+                continue
+
+            try:
+                # Tokenize the queries and convert them to tf-idf.
+                input_tfidfs = [self.ssearch.ksearch.getTfidfForText(future.text) for future in batch]
+
+                # Score all of the queries at once, using the largest topn.
+                topn = max([future.topn for future in batch])
+                results = self.ssearch.findSimilarBatch(input_tfidfs, topn=topn,
+                                                        chunksize=len(batch))
+            except Exception as e:
+                for future in batch:
+                    future.setError(e)
+                continue
+
+            # Hand each caller their own results.
+            for (future, future_results) in zip(batch, results):
+                future.setResults(future_results[0:future.topn])
+
+            self.num_batches += 1
+            self.num_queries += len(batch)
@@ -5,13 +5,19 @@ Created on Mon Oct 17 21:19:15 2016
 @author: Chris
 """
 
-import nltk
 import re
+import pickle
+import numpy as np
 from gensim import corpora
 from gensim.models import TfidfModel
 from collections import defaultdict
-from keysearch import KeySearch
-from os import listdir, makedirs
+from multiprocessing import Pool
+from keysearch import KeySearch, findLineOffsets
+from tokenizer import getTokenizer
+from csrcorpus import CsrCorpus
+from positionalindex import PositionalIndex
+from invertedindex import InvertedIndex
+from os import listdir, makedirs, remove
 from os.path import isfile, join, exists
 
 
@@ -19,6 +25,34 @@ from os.path import isfile, join, exists
 # it in the save and load features.
 enc_format='utf-8'
 
+
+# The empty CorpusBuilder (holding just the parsing settings) used by each 
+# worker process of a parallel `addDirectory`, set by `initWorker`.
+worker_builder = None
+
+
+def initWorker(builder):
+    """
+    Initializes a worker process with a CorpusBuilder holding the settings to
+    parse with.
+    """
+    global worker_builder
+    
+    worker_builder = builder
+
+
+def parseFile(args):
+    """
+    Worker function which parses a single text file with `addFile`, and 
+    returns a CorpusBuilder holding just the documents from that file.
+    """
+    (filepath, filename) = args
+    
+    builder = worker_builder.copySettings()
+    builder.addFile(filepath=filepath, filename=filename)
+    
+    return builder
+
 class CorpusBuilder(object):
     """
     The CorpusBuilder object helps turn a collection of plain text documents 
@@ -68,7 +102,13 @@ class CorpusBuilder(object):
     =======
     The CorpusBuilder will convert all characters to lowercase, tokenize your
     document with NLTK, filter stop words, and gather word frequency
-    information.
+    information. (A faster, regex-based tokenizer can be selected with 
+    `setTokenizer`.)
+    
+    For very large collections of text, call `setSpoolDir` first to build the
+    corpus in streaming mode: the tokenized documents are written to a spool
+    file on disk rather than held in memory, and then read back in passes by
+    `buildCorpus`, which builds the indexes and tf-idf vectors on disk.
     
     The `buildCorpus` step takes the final collection of documents (now 
     represented as filtered lists of tokens), removes words that only occur 
@@ -114,6 +154,9 @@ class CorpusBuilder(object):
 
         self.files = []
         self.doc_line_nums = []
+        
+        # The byte offsets of the lines in each file, by filename.
+        self.line_offsets = {}
 
         # Count the occurrences of each word and store in 'frequency'.
         # This is a temporary data structure used for filtering out words
@@ -132,6 +175,14 @@ class CorpusBuilder(object):
         
         # Record any regex substitutions to make.
         self.sub_patterns = []
+        
+        # The name of the tokenizer to use, see tokenizer.py.
+        self.tokenizer = 'nltk'
+        
+        # In streaming mode, the directory to write the spool file to, and
+        # the open spool file. See `setSpoolDir`.
+        self.spool_dir = None
+        self.spool = None
 
     def setStopList(self, stop_words_file):
         """
@@ -178,6 +229,100 @@ class CorpusBuilder(object):
         # or just a separator (for example, an empty line)
         self.doc_start_is_separator = doc_start_is_separator
     
+    def setTokenizer(self, tokenizer):
+        """
+        Select the tokenizer to use, by name:
+            'nltk'  - NLTK's word_tokenize (the default).
+            'regex' - A single compiled regular expression, which is much 
+                      faster and agrees with NLTK on almost all tokens.
+        
+        The choice is saved with the KeySearch, so query text is always 
+        tokenized the same way as the corpus.
+        """
+        # Check that the name is valid.
+        getTokenizer(tokenizer)
+        
+        self.tokenizer = tokenizer
+    
+    def setSpoolDir(self, spool_dir):
+        """
+        Build the corpus in streaming mode, using the directory `spool_dir` 
+        for temporary files. This must be called before adding any documents.
+        
+        In streaming mode, each document's tokens are written to a spool file
+        as soon as the document is parsed, rather than kept in memory. 
+        `buildCorpus` then reads the spool file back once for each step, and 
+        builds the bag-of-words vectors, the inverted and positional indexes,
+        and the tf-idf vectors on disk in the spool directory (see 
+        `buildCorpusOnDisk`). This way the memory used grows with the size of
+        the vocabulary and the number of documents, but not with the amount
+        of text.
+        
+        The finished corpus is memory-mapped from the spool directory, so it
+        must be kept until the KeySearch has been saved.
+        """
+        assert(not self.titles)
+        
+        if not exists(spool_dir):
+            makedirs(spool_dir)
+        
+        self.spool_dir = spool_dir
+    
+    def storeDocument(self, doc):
+        """
+        Store the list of tokens for the next document, either in memory or 
+        in the spool file.
+        """
+        if self.spool_dir is None:
+            self.documents.append(doc)
+            return
+        
+        if self.spool is None:
+            self.spool = open(self.spool_dir + 'documents.spool', 'wb')
+        
+        pickle.dump(doc, self.spool, pickle.HIGHEST_PROTOCOL)
+    
+    def iterDocuments(self):
+        """
+        Generator which yields the list of tokens for each document, in order,
+        from memory or from the spool file.
+        """
+        if self.spool_dir is None:
+            for doc in self.documents:
+                yield doc
+            return
+        
+        # Finish writing the spool file.
+        if self.spool is not None:
+            self.spool.close()
+            self.spool = None
+        
+        if not exists(self.spool_dir + 'documents.spool'):
+            return
+        
+        with open(self.spool_dir + 'documents.spool', 'rb') as f:
+            while True:
+                try:
+                    yield pickle.load(f)
+                except EOFError:
+                    break
+    
+    def copySettings(self):
+        """
+        Returns a new, empty CorpusBuilder with the same parsing settings 
+        (stop list, document start pattern, substitutions, and tokenizer) as
+        this one.
+        """
+        builder = CorpusBuilder()
+        
+        builder.stoplist = self.stoplist
+        builder.doc_start_pattern = self.doc_start_pattern
+        builder.doc_start_is_separator = self.doc_start_is_separator
+        builder.sub_patterns = self.sub_patterns
+        builder.tokenizer = self.tokenizer
+        
+        return builder
+    
     def setSubstitutions(self, sub_patterns):
         """
         Set substitutions to be made during parsing. 
@@ -215,7 +360,7 @@ class CorpusBuilder(object):
         `addDocument` Performs the following steps:
             1. Record document title and tags.
             2. Convert all letters to lowercase.
-            2. Tokenize the document using NLTK.
+            2. Tokenize the document (using NLTK, by default).
             3. Filter stop words.
             4. Accumulate word frequency information.
                     
@@ -228,38 +373,13 @@ class CorpusBuilder(object):
         # Do not call `addDocument` after the corpus has been built.
         assert(not hasattr(self, 'dictionary'))
 
-        # Get the ID (index) of this document.
-        docID = len(self.documents)        
-
-        # Store the title.
-        self.titles.append(title)
-
-        # Store the list of tags for this doc.
-        self.docsToTags.append(tags)                         
-            
-        # Add mappings from the tags to this journal entry.
-        for tag in tags:
-            # Convert tags to lower case.        
-            tag = tag.lower()
-                
-            # Add the tag to the dictionary.
-            if tag in self.tagsToDocs:
-                self.tagsToDocs[tag].append(docID)
-            else:
-                self.tagsToDocs[tag] = [docID]   
-
-        # Store the filenames only once.
-        if filename in self.files:        
-            fileID = self.files.index(filename)
-        else:
-            self.files.append(filename)            
-            fileID = len(self.files) - 1
-
-        # Store the file and line numbers.
-        self.doc_line_nums.append((fileID, doc_start, doc_end))
+        # Record the document metadata.
+        self.addDocumentInfo(title, tags, filename, doc_start, doc_end)
 
         # Parse the document into a list of tokens.
         doc = []        
+        tokenize = getTokenizer(self.tokenizer)
+        
         lineNum = 0        
         
         # Parse each line in the document.
@@ -277,8 +397,8 @@ class CorpusBuilder(object):
             # If the string ends in a newline, remove it.
             line = line.replace('\n', ' ')
 
-            # Convert everything to lowercase, then use NLTK to tokenize.
-            tokens = nltk.word_tokenize(line.lower())
+            # Convert everything to lowercase, then tokenize.
+            tokens = tokenize(line.lower())
            
             # Remove stop words.
             tokens = [word for word in tokens if word not in self.stoplist]
@@ -288,10 +408,67 @@ class CorpusBuilder(object):
                 self.frequency[token] += 1            
 
             # Add these tokens to the list of tokens in the document.
-            doc = doc + tokens
+            doc.extend(tokens)
          
         # Add this document to the list of all documents.
-        self.documents.append(doc)
+        self.storeDocument(doc)
+    
+    def addDocumentInfo(self, title, tags, filename, doc_start, doc_end):
+        """
+        Record the metadata (title, tags, source file and line numbers) for 
+        the next document.
+        """
+        # Get the ID (index) of this document.
+        docID = len(self.titles)        
+
+        # Store the title.
+        self.titles.append(title)
+
+        # Store the list of tags for this doc.
+        self.docsToTags.append(tags)                         
+            
+        # Add mappings from the tags to this journal entry.
+        for tag in tags:
+            # Convert tags to lower case.        
+            tag = tag.lower()
+                
+            # Add the tag to the dictionary.
+            if tag in self.tagsToDocs:
+                self.tagsToDocs[tag].append(docID)
+            else:
+                self.tagsToDocs[tag] = [docID]   
+
+        # Store the filenames only once.
+        if filename in self.files:        
+            fileID = self.files.index(filename)
+        else:
+            self.files.append(filename)            
+            fileID = len(self.files) - 1
+
+        # Store the file and line numbers.
+        self.doc_line_nums.append((fileID, doc_start, doc_end))
+    
+    def mergeBuilder(self, builder):
+        """
+        Add all of the parsed documents from another CorpusBuilder, `builder`, 
+        to this one, in order, as though they had been added here.
+        """
+        # Do not merge after the corpus has been built.
+        assert(not hasattr(self, 'dictionary'))
+        
+        for i in range(0, len(builder.documents)):
+            (fileID, doc_start, doc_end) = builder.doc_line_nums[i]
+            
+            self.addDocumentInfo(builder.titles[i], builder.docsToTags[i],
+                                 builder.files[fileID], doc_start, doc_end)
+            
+            self.storeDocument(builder.documents[i])
+        
+        # Add up the word counts.
+        for (token, count) in builder.frequency.iteritems():
+            self.frequency[token] += count
+        
+        self.line_offsets.update(builder.line_offsets)
     
     
     def addFile(self, filepath, filename):
@@ -304,6 +481,10 @@ class CorpusBuilder(object):
         # Read in the text file
         with open(filepath) as f:
             content = f.readlines()
+        
+        # Record where each line starts, so the source text of the documents 
+        # can be read back directly.
+        self.line_offsets[filepath] = findLineOffsets(filepath)
 
         doc = []                
         doc_title = ""
@@ -371,20 +552,44 @@ class CorpusBuilder(object):
         doc_end = lineNum - 1 + 1;        
         self.addDocument(doc_title, doc, doc_tags, filename=filepath ,doc_start=doc_start, doc_end=doc_end)
    
-    def addDirectory(self, dir_path):
+    def addDirectory(self, dir_path, num_workers=1):
         """
         Add all of the .txt files in the specified directory to the corpus.
+        
+        If `num_workers` is more than 1, the files are parsed in parallel by a 
+        pool of worker processes. The parsed files are still added to the 
+        corpus in the same order as a serial build, so the doc ids come out 
+        exactly the same. (On Windows, the calling script must be protected 
+        by an `if __name__ == '__main__':` block to use the worker pool.)
         """
         # Get all the source text files.
         files = [f for f in listdir(dir_path) if isfile(join(dir_path, f))]
 
+        # Only parse the .txt files.    
+        files = [f for f in files if f[-4:] == '.txt']
+
+        if num_workers > 1:
+            pool = Pool(num_workers, initializer=initWorker, initargs=(self.copySettings(),))
+            
+            # Parse the files in the workers, and merge the results in order
+            # as they become available.
+            args = [(dir_path + f, f[0:-4]) for f in files]
+            
+            try:
+                for (f, builder) in zip(files, pool.imap(parseFile, args)):
+                    print '  Parsed file:', f
+                    self.mergeBuilder(builder)
+                
+                pool.close()
+            finally:
+                # Stop the workers if parsing failed, then wait for them.
+                pool.terminate()
+                pool.join()
+            return
+
         # For each file in the directory:
         for f in files:
 
-            # Only parse the .txt files.    
-            if not (f[-4:] == '.txt'):
-                continue   
-    
             print '  Parsing file:', f
             
             # Pass down to addFile.
@@ -396,30 +601,123 @@ class CorpusBuilder(object):
         Build the corpus from the documents:
             1. Remove words that only appeared once.
             2. Create the Dictionary object.
-            3. Convert the documents to simple bag-of-words representation.
-            4. Convert the bag-of-words vectors to tf-idf.
+            3. Record the positions of the words in each document.
+            4. Convert the documents to simple bag-of-words representation, and
+               build the inverted index from them.
+            5. Convert the bag-of-words vectors to tf-idf.
         """
-        # Remove words that only appear once.
-        self.documents = [[token for token in doc if self.frequency[token] > 1]
-                          for doc in self.documents]
+        # Each step reads through the documents again (from the spool file in
+        # streaming mode), rather than making filtered copies of them.
         
-        # Build a dictionary from the text.
-        self.dictionary = corpora.Dictionary(self.documents)
+        # Build a dictionary from the text, leaving out words that only 
+        # appear once.
+        self.dictionary = corpora.Dictionary(self.iterFilteredDocuments())
+        
+        # In streaming mode, everything else is built out of core.
+        if self.spool_dir is not None:
+            self.buildCorpusOnDisk()
+            return
+        
+        # Build the positional index from the unfiltered documents, so that
+        # the removed words still count as a gap between their neighbors.
+        self.positional_index = PositionalIndex.build(self.iterDocuments(), self.dictionary)
         
         # Map the documents to vectors.
-        corpus = [self.dictionary.doc2bow(text) for text in self.documents]
+        corpus = [self.dictionary.doc2bow(text) for text in self.iterFilteredDocuments()]
 
         # Delete the tokenized representation of the documents--no need to
         # carry this around!
         del self.documents[:]
+        
+        # Build the inverted index from the word counts, so that it also has
+        # the term frequencies and document lengths needed for ranking.
+        bow_matrix = CsrCorpus.fromCorpus(corpus, num_terms=len(self.dictionary)).matrix
+        self.inverted_index = InvertedIndex.build(bow_matrix, term_freqs=True)
+        del bow_matrix
 
         # Convert the simple bag-of-words vectors to a tf-idf representation.        
         self.tfidf_model = TfidfModel(corpus)
-        self.corpus_tfidf = self.tfidf_model[corpus]
+        
+        # Apply the tf-idf model to the corpus just once, and store the 
+        # result as a sparse matrix (rather than as a lazily transformed 
+        # corpus, which would re-apply the model on every pass).
+        self.corpus_tfidf = CsrCorpus.fromCorpus(self.tfidf_model[corpus], 
+                                                 num_terms=len(self.dictionary))
+    
+    def buildCorpusOnDisk(self):
+        """
+        The rest of `buildCorpus` in streaming mode, once the dictionary has
+        been built. Each step streams through the spool file or the bag-of-
+        words corpus, and writes its output to the spool directory:
+            1. Write the bag-of-words vectors to an MmCorpus.
+            2. Build the inverted index from the MmCorpus.
+            3. Build the positional index from the spool file, using the
+               layout of the inverted index.
+            4. Train the tf-idf model on the MmCorpus, and write the tf-idf
+               vectors to a CsrCorpus.
+        
+        The indexes and the tf-idf corpus are memory-mapped from their files,
+        so only arrays with one entry per word or per document are held in
+        memory. The spool directory must be kept until the KeySearch has been
+        saved. The files all start with 'spool.', so the KeySearch may be 
+        saved into the spool directory itself without overwriting them.
+        """
+        bow_file = self.spool_dir + 'spool.bow.mm'
+        
+        bow_vecs = (self.dictionary.doc2bow(text) for text in self.iterFilteredDocuments())
+        
+        corpora.MmCorpus.serialize(bow_file, bow_vecs)
+        corpus = corpora.MmCorpus(bow_file)
+        
+        # The number of documents containing each word is the length of its
+        # postings list.
+        doc_freqs = np.zeros(len(self.dictionary), dtype=np.int64)
+        for (word_id, doc_freq) in self.dictionary.dfs.iteritems():
+            doc_freqs[word_id] = doc_freq
+        
+        self.inverted_index = InvertedIndex.buildOnDisk(corpus, doc_freqs,
+                                                        self.spool_dir + 'spool.inverted')
+        
+        # Build the positional index from the unfiltered documents, so that
+        # the removed words still count as a gap between their neighbors.
+        self.positional_index = PositionalIndex.buildOnDisk(self.iterDocuments(), self.dictionary,
+                                                            self.inverted_index,
+                                                            self.spool_dir + 'spool.positions')
+        
+        # The tokenized documents are no longer needed. (There's no spool file
+        # if no documents were added.)
+        if exists(self.spool_dir + 'documents.spool'):
+            remove(self.spool_dir + 'documents.spool')
+        
+        self.tfidf_model = TfidfModel(corpus)
+        
+        self.corpus_tfidf = CsrCorpus.fromCorpusOnDisk(self.tfidf_model[corpus], 
+                                                       len(self.dictionary),
+                                                       self.spool_dir + 'spool.tfidf',
+                                                       max_nnz=corpus.num_nnz)
+        
+        # Nor are the bag-of-words vectors.
+        del corpus
+        remove(bow_file)
+        if exists(bow_file + '.index'):
+            remove(bow_file + '.index')
+    
+    def iterFilteredDocuments(self):
+        """
+        Generator which yields each document with the words that only appear
+        once in the corpus removed.
+        """
+        for doc in self.iterDocuments():
+            yield [token for token in doc if self.frequency[token] > 1]
     
     def toKeySearch(self):
         ksearch = KeySearch(self.dictionary, self.tfidf_model, 
                             self.corpus_tfidf, self.titles, self.tagsToDocs,
-                            self.docsToTags, self.files, self.doc_line_nums)        
+                            self.docsToTags, self.files, self.doc_line_nums,
+                            inverted_index=self.inverted_index,
+                            positional_index=self.positional_index,
+                            line_offsets=[self.line_offsets.get(f) for f in self.files],
+                            tokenizer=self.tokenizer,
+                            stoplist=set(self.stoplist))        
         
         return ksearch
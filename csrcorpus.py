@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+"""
+This module provides a binary, memory-mappable storage format for the tf-idf
+corpus.
+"""
+
+import numpy as np
+from scipy import sparse
+from gensim import matutils, utils
+
+
+class CsrCorpus(utils.SaveLoad):
+    """
+    CsrCorpus holds a corpus of sparse vectors as the rows of a
+    scipy.sparse.csr_matrix, while behaving like any other gensim corpus:
+    iterating over it, or indexing it with a doc id, gives the documents as
+    lists of (word_id, value) tuples.
+
+    Unlike MmCorpus, which is a text format that has to be parsed, the
+    matrix is saved as raw numpy arrays. Loading it with mmap='r' maps those
+    arrays straight from disk, so multiple processes can share one copy of
+    the corpus through the OS page cache.
+    """
+    def __init__(self, matrix):
+        """
+        `matrix` is a (num_docs x num_terms) scipy.sparse.csr_matrix.
+        """
+        self.matrix = matrix
+
+    @classmethod
+    def fromCorpus(cls, corpus, num_terms, dtype=np.float32):
+        """
+        Create a CsrCorpus by reading through any gensim `corpus` once.
+        """
+        # corpus2csc stores the documents as columns, so transpose it.
+        matrix = matutils.corpus2csc(corpus, num_terms=num_terms, dtype=dtype).T.tocsr()
+        matrix.sort_indices()
+
+        return cls(matrix)
+
+    @classmethod
+    def fromCorpusOnDisk(cls, corpus, num_terms, fname, block_size=4096, 
+                         dtype=np.float32, max_nnz=None):
+        """
+        Create a CsrCorpus by reading through any gensim `corpus` once, like
+        `fromCorpus`, but without holding the matrix in memory. 
+        
+        The documents are converted `block_size` at a time, and the indices 
+        and values of each block are appended to the files `fname`.indices 
+        and `fname`.data, which are then memory-mapped (read-only). Only the
+        row pointers, one per document, are kept in memory. The files must be
+        kept until the corpus has been saved elsewhere with `save`.
+
+        `max_nnz` is an optional upper bound on the number of non-zero values,
+        used to choose 64-bit indices if there could be too many for 32-bit
+        ones.
+        """
+        index_dtype = np.int32
+        if max_nnz is not None and max_nnz > np.iinfo(np.int32).max:
+            index_dtype = np.int64
+
+        row_ptrs = [np.zeros(1, dtype=np.int64)]
+        nnz = 0
+
+        with open(fname + '.indices', 'wb') as indices_file:
+            with open(fname + '.data', 'wb') as data_file:
+                for block in utils.grouper(corpus, block_size):
+                    block_matrix = cls.fromCorpus(block, num_terms, dtype).matrix
+
+                    block_matrix.indices.astype(index_dtype).tofile(indices_file)
+                    block_matrix.data.astype(dtype).tofile(data_file)
+
+                    row_ptrs.append(block_matrix.indptr[1:].astype(np.int64) + nnz)
+                    nnz += block_matrix.nnz
+
+        indptr = np.concatenate(row_ptrs).astype(index_dtype)
+
+        # np.memmap can't map an empty file.
+        if nnz == 0:
+            indices = np.zeros(0, dtype=index_dtype)
+            data = np.zeros(0, dtype=dtype)
+        else:
+            indices = np.memmap(fname + '.indices', dtype=index_dtype, mode='r', shape=(nnz,))
+            data = np.memmap(fname + '.data', dtype=dtype, mode='r', shape=(nnz,))
+
+        # Each block's indices were already sorted by `fromCorpus`.
+        matrix = sparse.csr_matrix((data, indices, indptr), shape=(len(indptr) - 1, num_terms))
+        matrix.has_sorted_indices = True
+
+        return cls(matrix)
+
+    def __len__(self):
+        return self.matrix.shape[0]
+
+    def __getitem__(self, doc_id):
+        """
+        Return the vector for document `doc_id` as a list of
+        (word_id, value) tuples.
+        """
+        start = self.matrix.indptr[doc_id]
+        end = self.matrix.indptr[doc_id + 1]
+
+        return list(zip(self.matrix.indices[start:end].tolist(),
+                        self.matrix.data[start:end].tolist()))
+
+    def __iter__(self):
+        for doc_id in range(0, len(self)):
+            yield self[doc_id]
+
+    def save(self, fname):
+        """
+        Write the corpus to `fname`, with the matrix arrays stored in separate
+        files so that they can be memory-mapped by `load`.
+        """
+        super(CsrCorpus, self).save(fname, sep_limit=0)
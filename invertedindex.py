@@ -0,0 +1,333 @@
+# -*- coding: utf-8 -*-
+"""
+This module provides an inverted index over the corpus, for fast boolean 
+and ranked keyword search.
+"""
+
+import math
+import numpy as np
+from os import remove
+from gensim import matutils, utils
+from searchutils import selectTopN, selectUintType, createArray, narrowArray
+
+
+class InvertedIndex(utils.SaveLoad):
+    """
+    InvertedIndex maps each word in the vocabulary to its "postings list": the
+    sorted array of ids of the documents which contain the word.
+
+    All of the postings lists are stored end-to-end in a single array,
+    `doc_ids`, and the postings for word `word_id` are found at:
+        doc_ids[postings_ptr[word_id]:postings_ptr[word_id + 1]]
+
+    This is the same layout as a scipy.sparse.csc_matrix, so the index is
+    built directly from the columns of the tf-idf (or bag-of-words) matrix. 
+    Like CsrCorpus, the arrays are saved as raw numpy files which can be 
+    memory-mapped by `load`.
+
+    When built from the bag-of-words counts, the index also stores the number 
+    of times each word occurs in each document (`term_freqs`, aligned with 
+    `doc_ids`) and the length of each document (`doc_lengths`), which are 
+    needed to rank the results with BM25.
+    """
+    def __init__(self, doc_ids, postings_ptr, num_docs, term_freqs=None, doc_lengths=None):
+        self.doc_ids = doc_ids
+        self.postings_ptr = postings_ptr
+        self.num_docs = num_docs
+        self.term_freqs = term_freqs
+        self.doc_lengths = doc_lengths
+
+    @classmethod
+    def build(cls, matrix, term_freqs=False):
+        """
+        Build the index from a (num_docs x vocab_size) csr_matrix of document
+        vectors. 
+        
+        Pass term_freqs=True if the matrix holds the bag-of-words counts, to
+        store the term frequencies and document lengths for BM25.
+        """
+        # The columns of the matrix are the postings lists.
+        by_word = matrix.tocsc()
+        by_word.sort_indices()
+
+        doc_ids = by_word.indices.astype(np.int32)
+        postings_ptr = by_word.indptr.astype(np.int64)
+
+        if not term_freqs:
+            return cls(doc_ids, postings_ptr, matrix.shape[0])
+
+        # Store the counts with the smallest type that fits.
+        counts = by_word.data.astype(np.int64)
+        max_count = counts.max() if len(counts) else 0
+
+        doc_lengths = np.asarray(matrix.sum(axis=1)).ravel().astype(np.float32)
+
+        return cls(doc_ids, postings_ptr, matrix.shape[0], 
+                   counts.astype(selectUintType(max_count)), doc_lengths)
+
+    @classmethod
+    def buildOnDisk(cls, corpus, doc_freqs, fname, block_size=4096):
+        """
+        Build the index with term frequencies, like `build`, but without 
+        holding the postings in memory. `corpus` is any gensim corpus of the
+        bag-of-words counts (such as an MmCorpus), which is read through once.
+
+        `doc_freqs` is an array with the number of documents containing each
+        word (from the gensim Dictionary's `dfs`), which is the length of each
+        postings list. So the layout of the index is known up front, and the
+        postings of each block of `block_size` documents are written straight
+        into their places in the arrays, which are created on disk as 
+        `fname`.doc_ids.npy and `fname`.term_freqs.npy. The documents are read
+        in order, so each postings list comes out sorted.
+
+        The returned index holds the arrays memory-mapped from those files, so
+        they must be kept until the index has been saved elsewhere. Only the 
+        document lengths, one per document, are kept in memory.
+        """
+        num_words = len(doc_freqs)
+
+        postings_ptr = np.zeros(num_words + 1, dtype=np.int64)
+        postings_ptr[1:] = np.cumsum(doc_freqs)
+
+        doc_ids = createArray(fname + '.doc_ids.npy', np.int32, postings_ptr[-1])
+        
+        # The counts are written as uint32 first, then copied to the smallest
+        # type that fits once the largest count is known.
+        counts = createArray(fname + '.term_freqs.tmp.npy', np.uint32, postings_ptr[-1])
+        max_count = 0
+
+        # Where the next posting of each word goes.
+        next_posting = postings_ptr[0:num_words].copy()
+
+        doc_lengths = []
+        num_docs = 0
+
+        for block in utils.grouper(corpus, block_size):
+            # The block as a (num_docs x vocab_size) matrix.
+            matrix = matutils.corpus2csc(block, num_terms=num_words, 
+                                         num_docs=len(block), dtype=np.int64).T.tocsr()
+            
+            block_words = matrix.indices.astype(np.int64)
+            block_docs = np.repeat(np.arange(num_docs, num_docs + len(block)), 
+                                   np.diff(matrix.indptr))
+            block_counts = matrix.data
+
+            # Group the postings by word, keeping them in order of doc id.
+            order = np.argsort(block_words, kind='mergesort')
+            block_words = block_words[order]
+
+            # Find the start of each word's run, and the index of each posting
+            # within its run.
+            run_starts = np.flatnonzero(np.append(True, block_words[1:] != block_words[:-1]))
+            run_lens = np.diff(np.append(run_starts, len(block_words)))
+            ranks = np.arange(len(block_words)) - np.repeat(run_starts, run_lens)
+
+            # Write the postings into place.
+            targets = next_posting[block_words] + ranks
+            doc_ids[targets] = block_docs[order]
+            counts[targets] = block_counts[order]
+
+            next_posting[block_words[run_starts]] += run_lens
+
+            if len(block_counts):
+                max_count = max(max_count, block_counts.max())
+
+            doc_lengths.append(np.asarray(matrix.sum(axis=1)).ravel().astype(np.float32))
+            num_docs += len(block)
+
+        doc_lengths = np.concatenate(doc_lengths + [np.zeros(0, dtype=np.float32)])
+
+        # Store the counts with the smallest type that fits.
+        term_freqs = narrowArray(counts, max_count, fname + '.term_freqs.npy')
+        del counts
+        remove(fname + '.term_freqs.tmp.npy')
+
+        return cls(doc_ids, postings_ptr, num_docs, term_freqs, doc_lengths)
+
+    def getPostings(self, word_id):
+        """
+        Returns the sorted array of ids of the documents containing `word_id`.
+        """
+        return self.doc_ids[self.postings_ptr[word_id]:self.postings_ptr[word_id + 1]]
+
+    def getDocFreq(self, word_id):
+        """
+        Returns the number of documents containing `word_id`.
+        """
+        return int(self.postings_ptr[word_id + 1] - self.postings_ptr[word_id])
+
+    def getPostingsForAny(self, word_ids):
+        """
+        Returns the sorted array of ids of the documents containing any of the
+        words in the list `word_ids` (a single word id may also be given).
+        """
+        if isinstance(word_ids, (int, long, np.integer)):
+            return self.getPostings(word_ids)
+
+        if len(word_ids) == 1:
+            return self.getPostings(word_ids[0])
+
+        return np.unique(np.concatenate([self.getPostings(word_id) for word_id in word_ids]))
+
+    def containsDocs(self, candidates, postings):
+        """
+        Returns a boolean mask marking which of the doc ids in `candidates`
+        are in the sorted array `postings`.
+
+        Each candidate is looked up in the postings list with a binary search,
+        so this takes O(C log P) time for C candidates and P postings. This
+        makes it cheap to filter a short list of candidates by even the most
+        common words.
+        """
+        if len(postings) == 0 or len(candidates) == 0:
+            return np.zeros(len(candidates), dtype=bool)
+
+        positions = np.searchsorted(postings, candidates)
+        positions[positions == len(postings)] = 0
+
+        return postings[positions] == candidates
+
+    def search(self, include_ids=[], exclude_ids=[], docs=None):
+        """
+        Returns the ids of the documents which contain all of the words in
+        `include_ids` and none of the words in `exclude_ids`, as an array.
+
+        Each entry of `include_ids` is either a word id, or a list of word ids
+        of which the document must contain at least one (for example, the
+        expansions of a wildcard).
+
+        If `docs` is given, only those documents are searched, and the results
+        are returned in the same order as `docs`. Otherwise, the results are
+        in order of doc id.
+        """
+        # Check the shortest postings lists first, since they eliminate the
+        # most candidates.
+        include_postings = sorted([self.getPostingsForAny(word_ids) for word_ids in include_ids],
+                                  key=len)
+
+        # Choose the starting set of candidates: either the documents to
+        # search in, or else the shortest postings list.
+        if docs is not None:
+            candidates = np.asarray(docs, dtype=np.int64)
+        elif include_postings:
+            candidates = include_postings[0]
+            include_postings = include_postings[1:]
+        else:
+            candidates = np.arange(self.num_docs)
+
+        # Intersect with the postings of each included word.
+        for postings in include_postings:
+            candidates = candidates[self.containsDocs(candidates, postings)]
+
+        # Remove the postings of each excluded word.
+        for word_id in exclude_ids:
+            candidates = candidates[~self.containsDocs(candidates, self.getPostings(word_id))]
+
+        return candidates
+
+    def searchBM25(self, query, topn=10, candidates=None, k1=1.2, b=0.75):
+        """
+        Rank the documents against the query with BM25, and return the top N
+        as a list of tuples in the form:
+            (doc_id, score)
+        
+        `query` is a bag-of-words vector, a list of (word_id, count) tuples.
+        `candidates` optionally restricts the search to a sorted array of doc
+        ids.
+        
+        The query words are scored one at a time, starting with the one that
+        can contribute the most, while accumulating the document scores. Once
+        the current Nth best score is higher than the most that any unseen
+        document could still score, documents are no longer added, and any
+        document which can no longer reach the top N is dropped. So for 
+        queries with common words, most matching documents are never fully
+        scored.
+        """
+        if self.term_freqs is None:
+            raise ValueError('BM25 requires term frequencies, but this index was built without them.')
+
+        if topn < 1:
+            return []
+
+        avg_length = max(float(self.doc_lengths.mean()), 1.0)
+
+        # Calculate the IDF of each query word, and the most it could add to
+        # any document's score (the BM25 term frequency factor is less than
+        # (k1 + 1)).
+        terms = []
+        for (word_id, count) in query:
+            doc_freq = self.getDocFreq(word_id)
+
+            if doc_freq == 0:
+                continue
+
+            idf = count * math.log(1.0 + (self.num_docs - doc_freq + 0.5) / (doc_freq + 0.5))
+
+            terms.append((idf * (k1 + 1.0), idf, word_id))
+
+        terms.sort(reverse=True)
+
+        # The accumulated scores, kept sorted by doc id.
+        acc_ids = np.zeros(0, dtype=np.int64)
+        acc_scores = np.zeros(0, dtype=np.float64)
+
+        for i in range(0, len(terms)):
+            (upper_bound, idf, word_id) = terms[i]
+
+            # The maximum score still to be added by the words after this one.
+            remaining = sum([terms[j][0] for j in range(i + 1, len(terms))])
+
+            start = self.postings_ptr[word_id]
+            end = self.postings_ptr[word_id + 1]
+
+            doc_ids = self.doc_ids[start:end].astype(np.int64)
+            tfs = self.term_freqs[start:end].astype(np.float64)
+
+            if candidates is not None:
+                keep = self.containsDocs(doc_ids, candidates)
+                doc_ids = doc_ids[keep]
+                tfs = tfs[keep]
+
+            # The current Nth best score. Scores only ever increase, so the 
+            # final Nth best score will be at least this.
+            threshold = 0.0
+            if len(acc_scores) >= topn:
+                threshold = np.partition(acc_scores, len(acc_scores) - topn)[len(acc_scores) - topn]
+
+            # If a document which hasn't been seen yet couldn't reach the
+            # threshold, only score the documents we already have.
+            if threshold > upper_bound + remaining:
+                keep = self.containsDocs(doc_ids, acc_ids)
+                doc_ids = doc_ids[keep]
+                tfs = tfs[keep]
+
+            lengths = self.doc_lengths[doc_ids]
+            scores = idf * tfs * (k1 + 1.0) / (tfs + k1 * (1.0 - b + b * lengths / avg_length))
+
+            # Add the scores to the accumulators, adding any new documents.
+            is_new = ~self.containsDocs(doc_ids, acc_ids)
+
+            if is_new.any():
+                merged_ids = np.union1d(acc_ids, doc_ids[is_new])
+                merged_scores = np.zeros(len(merged_ids), dtype=np.float64)
+                merged_scores[np.searchsorted(merged_ids, acc_ids)] = acc_scores
+
+                acc_ids = merged_ids
+                acc_scores = merged_scores
+
+            acc_scores[np.searchsorted(acc_ids, doc_ids)] += scores
+
+            # Drop the documents which can no longer reach the top N.
+            if threshold > 0:
+                keep = acc_scores + remaining >= threshold
+                acc_ids = acc_ids[keep]
+                acc_scores = acc_scores[keep]
+
+        return [(int(acc_ids[i]), float(score)) for (i, score) in selectTopN(acc_scores, topn)]
+
+    def save(self, fname):
+        """
+        Write the index to `fname`, with the arrays stored in separate files
+        so that they can be memory-mapped by `load`.
+        """
+        super(InvertedIndex, self).save(fname, sep_limit=0)
@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+"""
+This module provides an approximate nearest neighbor index for the LSI
+vectors, as an alternative to comparing a query against every document.
+"""
+
+import numpy as np
+from gensim import utils
+from searchutils import selectTopN
+
+
+class IVFIndex(utils.SaveLoad):
+    """
+    IVFIndex, short for "inverted file index", divides the LSI vectors into
+    a number of "cells" by clustering them with k-means. Each cell stores the
+    list of documents which are closest to its centroid.
+
+    At query time, the query is compared against the cell centroids, and only
+    the documents in the `nprobe` nearest cells are scored. This makes the
+    search approximate--the true nearest neighbor may fall in a cell which
+    wasn't probed--but it only has to look at a fraction of the corpus. The
+    `nprobe` parameter controls the trade-off between speed and recall; use
+    `SimSearch.measureRecall` to tune it.
+
+    The index does not hold its own copy of the LSI vectors, it just refers
+    to the vectors in the SimSearch index (which must be normalized).
+    """
+    def __init__(self, vectors, centroids, cell_offsets, cell_doc_ids, nprobe=8):
+        """
+        Use `IVFIndex.build` to create a new index.
+
+        Parameters:
+            vectors - The (num_docs x num_topics) matrix of normalized LSI
+                      vectors.
+            centroids - The (num_cells x num_topics) matrix of normalized
+                        cell centroids.
+            cell_offsets - The documents in cell `i` are stored in
+                           cell_doc_ids[cell_offsets[i]:cell_offsets[i + 1]].
+            cell_doc_ids - The doc ids in each cell, grouped by cell.
+            nprobe - The number of cells to search for each query.
+        """
+        self.vectors = vectors
+        self.centroids = centroids
+        self.cell_offsets = cell_offsets
+        self.cell_doc_ids = cell_doc_ids
+        self.nprobe = nprobe
+
+    @classmethod
+    def build(cls, vectors, num_cells=None, nprobe=8, num_iters=10,
+              sample_size=None, block_size=4096, seed=0):
+        """
+        Build an IVFIndex over the normalized LSI `vectors`.
+
+        The cell centroids are learned by running spherical k-means on a
+        random sample of the vectors (`sample_size` vectors, by default 256
+        per cell), and then every vector is assigned to its nearest centroid.
+
+        If `num_cells` isn't specified, the square root of the number of
+        documents is used.
+        """
+        num_docs = len(vectors)
+
+        if num_cells is None:
+            num_cells = int(np.sqrt(num_docs))
+
+        num_cells = max(1, min(num_cells, num_docs))
+
+        if sample_size is None:
+            sample_size = 256 * num_cells
+
+        # Select the training sample, and use the first vectors in the sample
+        # as the initial centroids.
+        rng = np.random.RandomState(seed)
+        sample = vectors[np.sort(rng.permutation(num_docs)[0:min(sample_size, num_docs)])]
+        centroids = np.array(sample[rng.permutation(len(sample))[0:num_cells]])
+
+        for i in range(0, num_iters):
+            # Assign each training vector to its nearest centroid.
+            assignments = cls.assignCells(sample, centroids, block_size)
+
+            # Move each centroid to the (normalized) mean of its vectors.
+            sums = np.zeros(centroids.shape, dtype=np.float64)
+            np.add.at(sums, assignments, sample)
+
+            counts = np.bincount(assignments, minlength=num_cells)
+
+            # Re-seed any empty cells with random vectors from the sample.
+            empty = np.flatnonzero(counts == 0)
+            sums[empty] = sample[rng.randint(0, len(sample), len(empty))]
+
+            norms = np.linalg.norm(sums, axis=1)
+            norms[norms == 0] = 1.0
+            centroids = (sums / norms.reshape(-1, 1)).astype(vectors.dtype)
+
+        # Assign all of the documents to their cells.
+        assignments = cls.assignCells(vectors, centroids, block_size)
+
+        # Group the doc ids by cell. The stable sort keeps the ids in each cell
+        # in ascending order.
+        cell_doc_ids = np.argsort(assignments, kind='mergesort').astype(np.int32)
+        cell_offsets = np.zeros(num_cells + 1, dtype=np.int64)
+        cell_offsets[1:] = np.cumsum(np.bincount(assignments, minlength=num_cells))
+
+        return cls(vectors, centroids, cell_offsets, cell_doc_ids, nprobe)
+
+    @staticmethod
+    def assignCells(vectors, centroids, block_size=4096):
+        """
+        Returns the index of the nearest centroid to each of the `vectors`.
+
+        The vectors are processed in blocks to limit memory use.
+        """
+        assignments = np.zeros(len(vectors), dtype=np.int64)
+
+        for start in range(0, len(vectors), block_size):
+            sims = np.dot(vectors[start:start + block_size], centroids.T)
+            assignments[start:start + block_size] = np.argmax(sims, axis=1)
+
+        return assignments
+
+    def getCandidates(self, query, nprobe=None):
+        """
+        Returns the ids of all of the documents in the `nprobe` cells nearest
+        to `query`, in ascending order.
+        """
+        if nprobe is None:
+            nprobe = self.nprobe
+
+        nprobe = min(nprobe, len(self.centroids))
+
+        # Find the nearest cells.
+        cell_sims = np.dot(self.centroids, query)
+        cells = np.argpartition(-cell_sims, nprobe - 1)[0:nprobe]
+
+        # Gather the documents in those cells.
+        candidates = np.concatenate([self.cell_doc_ids[self.cell_offsets[c]:self.cell_offsets[c + 1]]
+                                     for c in cells])
+
+        return np.sort(candidates)
+
+    def search(self, query, topn=10, exclude=None, nprobe=None):
+        """
+        Find the approximate `topn` most similar documents to the normalized
+        LSI vector `query`.
+
+        `exclude` is an optional boolean mask over all documents; documents
+        marked True will not be returned.
+
+        Returns the results as a list of tuples in the form:
+            (doc_id, similarity_value)
+        """
+        candidates = self.getCandidates(query, nprobe)
+
+        # Remove any excluded documents.
+        if exclude is not None:
+            candidates = candidates[~exclude[candidates]]
+
+        # Score just the candidates. Since the candidates are in ascending
+        # order, ties are still broken by doc_id.
+        sims = np.dot(self.vectors[candidates], query)
+
+        return [(int(candidates[i]), sim) for (i, sim) in selectTopN(sims, topn)]
+
+    def save(self, fname):
+        """
+        Write the index to `fname`. The arrays are stored in separate files so
+        that they can be memory-mapped by `load`. The LSI vectors are not
+        included--they're saved with the SimSearch index.
+        """
+        super(IVFIndex, self).save(fname, sep_limit=0, ignore=['vectors'])
+
+    @classmethod
+    def load(cls, fname, vectors, mmap=None):
+        """
+        Load an index saved with `save`, attaching it to the LSI `vectors`.
+
+        Pass mmap='r' to memory-map the arrays rather than reading them in.
+        """
+        ivf_index = super(IVFIndex, cls).load(fname, mmap=mmap)
+        ivf_index.vectors = vectors
+
+        return ivf_index
@@ -7,15 +7,41 @@ Created on Tue Nov 22 11:31:44 2016
 
 import textwrap
 import pickle
-import nltk
+import bisect
+import fnmatch
+import re
+import numpy as np
 from gensim import corpora
 from gensim.models import TfidfModel
+from csrcorpus import CsrCorpus
+from invertedindex import InvertedIndex
+from positionalindex import PositionalIndex
+from tokenizer import getTokenizer
+from os.path import exists
 
 
 # I lazily made this a global constant so that I wouldn't have to include
 # it in the save and load features.
 enc_format='utf-8'
 
+
+def findLineOffsets(filename):
+    """
+    Read through the text file `filename` once, and return the byte offset of
+    the start of each line as a numpy array. The array has one extra entry at
+    the end, holding the size of the file.
+    
+    Line number `n` (numbered from 1) starts at offset `offsets[n - 1]`.
+    """
+    offsets = [0]
+    
+    # Read the file in binary mode, so that the offsets are in bytes.
+    with open(filename, 'rb') as f:
+        for line in f:
+            offsets.append(offsets[-1] + len(line))
+    
+    return np.asarray(offsets, dtype=np.int64)
+
 class KeySearch(object):
     """
     KeySearch, which is short for "keyword search" stores a completed gensim 
@@ -27,11 +53,14 @@ class KeySearch(object):
       1. It has functions for converting new text sources (that is, texts not
          already in the corpus) into tf-idf vectors.
       2. It stores the corpus vocabulary in the form of a gensim dictionary.
-      3. It supports boolean keyword search (though this is NOT indexed!).
+      3. It supports boolean keyword search, using an inverted index, as
+         well as phrase and proximity search (if the corpus was built with
+         a positional index).
       4. It stores the document metadata:
            - Title
            - Text source file
-           - Line numbers in source file
+           - Line numbers in source file (and the byte offsets of the lines, so
+             that a document's source text can be read directly)
            - Tags
     
     
@@ -47,7 +76,9 @@ class KeySearch(object):
 
     """
     def __init__(self, dictionary, tfidf_model, corpus_tfidf, titles, 
-                  tagsToDocs, docsToTags, files, doc_line_nums):
+                  tagsToDocs, docsToTags, files, doc_line_nums, 
+                  inverted_index=None, positional_index=None, line_offsets=None,
+                  tokenizer='nltk', stoplist=None):
         """
         KeySearch requires a completed gensim corpus, along with some 
         additional metadata
@@ -55,17 +86,51 @@ class KeySearch(object):
         Parameters:
             dictionary - gensim dictionary
             tfidf_model - gensim TfidfModel
-            corpus_tfidf - gensim corpora
+            corpus_tfidf - gensim corpora. If this isn't a CsrCorpus, it is
+                           converted to one.
             titles - List of string titles.
             tagsToDocs - Mapping of tags to doc ids
             docsToTags - List of tags for each doc
             files - Unique files in the corpus
             doc_line_nums - 
+            inverted_index - InvertedIndex of the corpus. If this isn't 
+                             provided, it's built from the corpus (without the
+                             term frequencies needed for `rankedSearch`).
+            positional_index - Optional PositionalIndex of the corpus, needed
+                               for phrase and proximity search.
+            line_offsets - Optional list with the line offsets (see 
+                           `findLineOffsets`) of each file in `files`. Any 
+                           missing offsets are found when first needed.
+            tokenizer - Name of the tokenizer the corpus was built with (see
+                        tokenizer.py).
+            stoplist - Optional set of the stop words removed from the corpus.
+                       Phrase search needs it to tell stop words (which don't
+                       take up a position) from other words that aren't in 
+                       the dictionary (which do).
         """
         self.dictionary = dictionary
         self.tfidf_model = tfidf_model
+        
+        # Keep a sorted list of the vocabulary for prefix and wildcard lookups.
+        self.sorted_vocab = sorted(dictionary.token2id.keys())
+        
+        # Hold the tf-idf vectors in memory as the rows of a sparse matrix, so
+        # that they don't have to be re-computed or re-parsed on every pass.
+        if not isinstance(corpus_tfidf, CsrCorpus):
+            corpus_tfidf = CsrCorpus.fromCorpus(corpus_tfidf, num_terms=len(dictionary))
+        
         self.corpus_tfidf = corpus_tfidf
         
+        # Build the inverted index for keyword search.
+        if inverted_index is None:
+            inverted_index = InvertedIndex.build(corpus_tfidf.matrix)
+        
+        self.inverted_index = inverted_index
+        
+        # The positional index can only be built from the tokenized text, so
+        # it's provided by the CorpusBuilder.
+        self.positional_index = positional_index
+        
         self.titles = titles
     
         # Create mappings for the entry tags.
@@ -74,6 +139,15 @@ class KeySearch(object):
 
         self.files = files
         self.doc_line_nums = doc_line_nums
+        
+        if line_offsets is None:
+            line_offsets = [None] * len(files)
+        
+        self.line_offsets = line_offsets
+        
+        # Query text must be tokenized the same way as the corpus was.
+        self.tokenizer = tokenizer
+        self.stoplist = stoplist
     
     def printTags(self):
         """
@@ -97,6 +171,24 @@ class KeySearch(object):
         
         The input text should be a single string.
         """
+        tokens = self.tokenize(text)
+
+        # We don't need to do any special filtering of tokens here (stopwords, 
+        # infrequent words, etc.). If a token is not in the dictionary, it is 
+        # simply ignored. So the dictionary effectively does the token 
+        # filtering for us.
+
+        # Convert the tokenized text into a bag of words representation.
+        bow_vec = self.dictionary.doc2bow(tokens) 
+        
+        # Convert the bag-of-words representation to tf-idf
+        return self.tfidf_model[bow_vec]
+    
+    def tokenize(self, text):
+        """
+        Convert the string `text` to a list of lower case tokens, the same way
+        that the corpus text was tokenized.
+        """
         # If the string is not already unicode, decode the string into unicode
         # so the NLTK can handle it.
         if isinstance(text, str):
@@ -112,19 +204,8 @@ class KeySearch(object):
         # If the string ends in a newline, remove it.
         text = text.replace('\n', ' ')
 
-        # Convert everything to lowercase, then use NLTK to tokenize.
-        tokens = nltk.word_tokenize(text.lower())
-
-        # We don't need to do any special filtering of tokens here (stopwords, 
-        # infrequent words, etc.). If a token is not in the dictionary, it is 
-        # simply ignored. So the dictionary effectively does the token 
-        # filtering for us.
-
-        # Convert the tokenized text into a bag of words representation.
-        bow_vec = self.dictionary.doc2bow(tokens) 
-        
-        # Convert the bag-of-words representation to tf-idf
-        return self.tfidf_model[bow_vec]
+        # Convert everything to lowercase, then tokenize.
+        return getTokenizer(self.tokenizer)(text.lower())
     
     def getTfidfForFile(self, filename):
         """
@@ -146,13 +227,25 @@ class KeySearch(object):
         """        
         return self.corpus_tfidf[doc_id]
 
-    def keywordSearch(self, includes=[], excludes=[], docs=[]):
+    def getTfidfMatrix(self):
+        """
+        Returns the tf-idf corpus as a (num_docs x vocab_size) 
+        scipy.sparse.csr_matrix, with one row per document.
+        """
+        return self.corpus_tfidf.matrix
+
+    def keywordSearch(self, includes=[], excludes=[], docs=[], phrases=[], near=[]):
         """
         Performs a boolean keyword search over the corpus.
         
         All words in the dictionary are lower case. This function will convert
         all supplied keywords to lower case.
         
+        Keywords may contain the wildcards '*' and '?' (for example, 'bless*'). 
+        An included wildcard matches documents which contain *any* of the 
+        words it expands to, and an excluded wildcard removes documents which
+        contain any of them.
+        
         Parameters:
             includes    A list of words (as strings) that the documents 
                         *must include*.
@@ -161,68 +254,124 @@ class KeySearch(object):
             docs        The list of documents to search in, represented by
                         by doc_ids. If this list is empty, the entire corpus
                         is searched.
+            phrases     A list of phrases (as strings) that the documents
+                        *must include*, with the words next to each other
+                        and in order. Stop words are ignored, and any other
+                        words which aren't in the dictionary match any word.
+            near        A list of tuples (word1, word2, max_distance). The 
+                        documents must include the two words within 
+                        `max_distance` words of each other.
+        
+        Phrases and proximity require the positional index, which is built
+        by the CorpusBuilder.
         """
         
-        # If no doc ids were supplied, search the entire corpus.
-        if not docs:
-            docs = range(0, len(self.corpus_tfidf))
-    
         # Convert all the keywords to their IDs.
         # Force them to lower case in the process.
         include_ids = []
         exclude_ids = []
     
         for word in includes:
-            # Lookup the ID for the word.            
-            word_id = self.getIDForWord(word.lower())            
+            # Lookup the ID(s) for the word.            
+            word_ids = self.expandWord(word.lower())            
             
             # Verify the word exists in the dictionary.
-            if word_id == -1:
+            if not word_ids:
                 print 'WARNING: Word \'' + word.lower() + '\'not in dictionary!'
                 continue
             
-            # Add the word id to the list.
-            include_ids.append(word_id)
+            # Add the word ids to the list.
+            include_ids.append(word_ids)
             
         for word in excludes:
-            exclude_ids.append(self.getIDForWord(word.lower()))
+            # Words which aren't in the dictionary can't exclude anything.
+            exclude_ids.extend(self.expandWord(word.lower()))
         
-        results = []
-    
-        # For each of the documents to search...
+        # If no doc ids were supplied, search the entire corpus.
+        if not docs:
+            docs = None
         
-        for doc_id in docs:
-            # Get the sparse tf-idf vector for the next document.
-            vec_tfidf = self.corpus_tfidf[doc_id]
+        # Look up the matching documents in the inverted index.
+        results = self.inverted_index.search(include_ids, exclude_ids, docs)
+        
+        if not (phrases or near):
+            return results.tolist()
+        
+        if self.positional_index is None:
+            raise ValueError('Phrase and proximity search require a positional index, '
+                             'but this corpus was built without one.')
+        
+        # Check the positions of the words in the remaining documents.
+        for phrase in phrases:
+            tokens = self.tokenize(phrase)
             
-            # Create a list of the word ids in this document.
-            doc_words = [tfidf[0] for tfidf in vec_tfidf]
+            # Remove the stop words, like the corpus text. The remaining words
+            # which aren't in the dictionary (-1) are left as gaps in the 
+            # phrase, since they still take up a position in the documents. 
+            # Without the stop list, the two can't be told apart, so all of
+            # them are left out.
+            if self.stoplist is not None:
+                word_ids = self.getIDsForWords([t for t in tokens if t not in self.stoplist])
+            else:
+                word_ids = [word_id for word_id in self.getIDsForWords(tokens) if word_id != -1]
             
-            match = True
+            if all([word_id == -1 for word_id in word_ids]):
+                print 'WARNING: Phrase \'' + phrase + '\' has no words in the dictionary!'
+                continue
             
-            # Check for words that must be present.
-            for word_id in include_ids:
-                if not word_id in doc_words:
-                    match = False
-                    break
+            matches = self.positional_index.searchPhrase(word_ids, np.unique(results))
+            results = results[np.in1d(results, matches)]
+        
+        for (word1, word2, max_distance) in near:
+            (word_id1, word_id2) = self.getIDsForWords([word1, word2])
             
-            # If we failed the 'includes' test, skip to the next document.
-            if not match:
-                continue
-    
-            # Check for words that must not be present.
-            for word_id in exclude_ids:
-                if word_id in doc_words:
-                    match = False
-                    break
+            # A word which isn't in the dictionary can't be found near anything.
+            if word_id1 == -1 or word_id2 == -1:
+                return []
             
-            # If we passed the 'excludes' test, this is a valid result.
-            if match:
-                results.append(doc_id)
+            matches = self.positional_index.searchNear(word_id1, word_id2, max_distance,
+                                                       np.unique(results))
+            results = results[np.in1d(results, matches)]
         
-        return results
+        return results.tolist()
             
     
+    def rankedSearch(self, query, topn=10, includes=[], excludes=[], docs=[], 
+                     phrases=[], near=[], k1=1.2, b=0.75):
+        """
+        Performs a keyword search ranked with BM25, and returns the `topn` 
+        results as a list of tuples in the form:
+            (doc_id, score)
+        
+        This is the same form as SimSearch's results, so they can be displayed
+        with the SimSearch `printResults` functions.
+        
+        `query` is either a string of keywords, which is tokenized the same 
+        way as the corpus, or a bag-of-words vector (a list of (word_id, 
+        count) tuples). Any words that aren't in the dictionary are ignored.
+        
+        The results can optionally be restricted with the same `includes`, 
+        `excludes`, `docs`, `phrases`, and `near` filters as `keywordSearch`.
+        Pass topn=None to rank all of the documents which pass the filters.
+        `k1` and `b` are the usual BM25 parameters.
+        """
+        # Convert the query to a bag-of-words vector.
+        if isinstance(query, basestring):
+            query_bow = self.dictionary.doc2bow(self.tokenize(query))
+        else:
+            query_bow = query
+        
+        # Apply any boolean filters first.
+        candidates = None
+        if includes or excludes or docs or phrases or near:
+            candidates = np.unique(np.asarray(self.keywordSearch(includes, excludes, docs, 
+                                                                 phrases, near), dtype=np.int64))
+        
+        if topn is None:
+            topn = self.inverted_index.num_docs if candidates is None else len(candidates)
+        
+        return self.inverted_index.searchBM25(query_bow, topn, candidates, k1, b)
+    
     def printTopNWords(self, topn=10):
         """
         Print the 'topn' most frequent words in the corpus.
@@ -258,16 +407,72 @@ class KeySearch(object):
         
         Returns -1 if the word isn't in the dictionary.
         """
-
         # All words in dictionary are lower case.
-        input_word = input_word.lower()
+        return self.dictionary.token2id.get(input_word.lower(), -1)
+    
+    def getIDsForWords(self, input_words):
+        """
+        Lookup the IDs for a list of words, all at once.
         
-        # First check if the word exists in the dictionary.
-        if not input_word in self.dictionary.values():
-            return -1            
-        # If it is, look up the ID.    
-        else:
-            return self.dictionary.token2id[input_word]
+        Returns a list with the ID of each word, or -1 for any word that isn't
+        in the dictionary.
+        """
+        token2id = self.dictionary.token2id
+        
+        return [token2id.get(word.lower(), -1) for word in input_words]
+    
+    def getWordsWithPrefix(self, prefix):
+        """
+        Returns all of the words in the dictionary which start with `prefix`,
+        in alphabetical order.
+        """
+        prefix = prefix.lower()
+        
+        # Find the range of the sorted vocabulary which starts with the prefix.
+        start = bisect.bisect_left(self.sorted_vocab, prefix)
+        
+        end = start
+        while end < len(self.sorted_vocab) and self.sorted_vocab[end].startswith(prefix):
+            end += 1
+        
+        return self.sorted_vocab[start:end]
+    
+    def expandWildcard(self, pattern):
+        """
+        Returns all of the words in the dictionary which match `pattern`, in 
+        alphabetical order. The pattern may use '*' to match any number of 
+        characters and '?' to match a single character, as in 'bless*' or 
+        'wom?n'.
+        """
+        pattern = pattern.lower()
+        
+        # Only the words which start with the literal part of the pattern 
+        # (before the first wildcard) need to be checked.
+        prefix = re.split(r'[*?]', pattern, 1)[0]
+        words = self.getWordsWithPrefix(prefix)
+        
+        # A trailing '*' is just a prefix search.
+        if pattern == prefix + '*':
+            return words
+        
+        regex = re.compile(fnmatch.translate(pattern))
+        
+        return [word for word in words if regex.match(word)]
+    
+    def expandWord(self, word):
+        """
+        Returns the list of IDs for `word`, which may contain wildcards. The 
+        list is empty if nothing in the dictionary matches.
+        """
+        if ('*' in word) or ('?' in word):
+            return self.getIDsForWords(self.expandWildcard(word))
+        
+        word_id = self.getIDForWord(word)
+        
+        if word_id == -1:
+            return []
+        
+        return [word_id]
                
     def getDocLocation(self, doc_id):
         """
@@ -277,44 +482,87 @@ class KeySearch(object):
         filename = self.files[line_nums[0]]
         return filename, line_nums[1], line_nums[2]
     
+    def getLineOffsets(self, file_id):
+        """
+        Returns the line offsets for the file `file_id`, finding them first if
+        they haven't been recorded.
+        """
+        if self.line_offsets[file_id] is None:
+            self.line_offsets[file_id] = findLineOffsets(self.files[file_id])
+        
+        return self.line_offsets[file_id]
+    
+    def readLines(self, fp, file_id, line_start, line_end):
+        """
+        Read the lines `line_start` through `line_end` (numbered from 1) from
+        the open file `fp`, by seeking straight to the first one.
+        """
+        offsets = self.getLineOffsets(file_id)
+        
+        line_start = max(line_start, 1)
+        line_end = min(line_end, len(offsets) - 1)
+        
+        if line_start > line_end:
+            return []
+        
+        fp.seek(offsets[line_start - 1])
+        
+        return [fp.readline() for i in range(line_start, line_end + 1)]
+    
     def readDocSource(self, doc_id):
         """
         Reads the original source file for the document 'doc_id' and retrieves
         the source lines.
         """
         # Lookup the source for the doc.
-        line_nums = self.doc_line_nums[doc_id]        
+        (file_id, line_start, line_end) = self.doc_line_nums[doc_id]        
         
-        filename = self.files[line_nums[0]]
-        line_start = line_nums[1]
-        line_end = line_nums[2]
-
-        results = []        
-
         # Open the file and read just the specified lines.        
-        with open(filename) as fp:
-            for i, line in enumerate(fp):
-                # 'i' starts at 0 but line numbers start at 1.
-                line_num = i + 1
-                
-                if line_num > line_end:
-                    break
-                
-                if line_num >= line_start:
-                    results.append(line)
+        with open(self.files[file_id]) as fp:
+            return self.readLines(fp, file_id, line_start, line_end)
     
+    def readDocSources(self, doc_ids):
+        """
+        Reads the source lines for all of the documents in `doc_ids` (for 
+        example, a page of search results), opening each source file only 
+        once.
+        
+        Returns a list with the source lines of each document, in the same 
+        order as `doc_ids`.
+        """
+        # Group the documents by file.
+        by_file = {}
+        for i in range(0, len(doc_ids)):
+            file_id = self.doc_line_nums[doc_ids[i]][0]
+            by_file.setdefault(file_id, []).append(i)
+        
+        results = [None] * len(doc_ids)
+        
+        for (file_id, indeces) in by_file.iteritems():
+            
+            # Read the documents in the order they appear in the file.
+            indeces.sort(key=lambda i: self.doc_line_nums[doc_ids[i]][1])
+            
+            with open(self.files[file_id]) as fp:
+                for i in indeces:
+                    (_, line_start, line_end) = self.doc_line_nums[doc_ids[i]]
+                    results[i] = self.readLines(fp, file_id, line_start, line_end)
+        
         return results
     
-    def printDocSourcePretty(self, doc_id, max_lines=8, indent='    '):
+    def printDocSourcePretty(self, doc_id, max_lines=8, indent='    ', lines=None):
         """
-        Prints the original source lines for the document 'doc_id'.
+        Prints the original source lines for the document 'doc_id'. If the 
+        `lines` have already been read (with `readDocSources`), they can be 
+        passed in.
         
         This function leverages the 'textwrap' Python module to limit the 
         print output to 80 columns.        
         """
             
         # Read in the document.
-        lines = self.readDocSource(doc_id)
+        if lines is None:
+            lines = self.readDocSource(doc_id)
             
         # Limit the result to 'max_lines'.
         truncated = False
@@ -354,6 +602,17 @@ class KeySearch(object):
         # Write out the tfidf corpus.
         corpora.MmCorpus.serialize(save_dir + 'documents_tfidf.mm', self.corpus_tfidf)  
 
+        # Also write the tfidf corpus in binary form, which can be loaded
+        # quickly and memory-mapped.
+        self.corpus_tfidf.save(save_dir + 'documents_tfidf.csr')
+
+        # Write out the inverted index.
+        self.inverted_index.save(save_dir + 'documents.inverted')
+        
+        # Write out the positional index, if there is one.
+        if self.positional_index is not None:
+            self.positional_index.save(save_dir + 'documents.positions')
+        
         # Write out the dictionary.
         self.dictionary.save(save_dir + 'documents.dict')
         
@@ -363,31 +622,76 @@ class KeySearch(object):
         # Save the file ID and line numbers for each document.
         pickle.dump(self.doc_line_nums, open(save_dir + 'doc_line_nums.pickle', 'wb'))
         
+        # Save the name of the tokenizer.
+        pickle.dump(self.tokenizer, open(save_dir + 'tokenizer.pickle', 'wb'))
+        
+        # Save the line offsets for each file.
+        pickle.dump(self.line_offsets, open(save_dir + 'line_offsets.pickle', 'wb'), 
+                    pickle.HIGHEST_PROTOCOL)
+        
+        # Save the stop list, which phrase search uses to line up the words
+        # of the phrase with their positions.
+        if self.stoplist is not None:
+            pickle.dump(self.stoplist, open(save_dir + 'stoplist.pickle', 'wb'))
+        
         # Objects that are not saved:
-        #  - stop_list - You don't need to filter stop words for new input
-        #                text, they simply aren't found in the dictionary.
         #  - frequency - This preliminary word count object is only used for
         #                removing infrequent words. Final word counts are in
         #                the `dictionary` object.
         
     @classmethod
-    def load(cls, save_dir='./'):
+    def load(cls, save_dir='./', mmap=None):
         """
         Load the corpus from a save directory.
+        
+        Pass mmap='r' to memory-map the tf-idf corpus from disk (read-only) 
+        rather than reading it into memory. This makes loading much faster, 
+        and lets multiple processes share a single copy of the corpus.
         """
         tables = pickle.load(open(save_dir + 'tag-tables.pickle', 'rb'))
         tagsToDocs = tables[0]
         docsToTags = tables[1]        
         titles = pickle.load(open(save_dir + 'titles.pickle', 'rb'))
         tfidf_model = TfidfModel.load(fname=save_dir + 'documents.tfidf_model')
-        corpus_tfidf = corpora.MmCorpus(save_dir + 'documents_tfidf.mm')
+        
+        # Use the binary tfidf corpus if it's available. (Otherwise, the text
+        # corpus is read into a CsrCorpus once by the constructor.)
+        if exists(save_dir + 'documents_tfidf.csr'):
+            corpus_tfidf = CsrCorpus.load(save_dir + 'documents_tfidf.csr', mmap=mmap)
+        else:
+            corpus_tfidf = corpora.MmCorpus(save_dir + 'documents_tfidf.mm')
+        
         dictionary = corpora.Dictionary.load(fname=save_dir + 'documents.dict')
         files = pickle.load(open(save_dir + 'files.pickle', 'rb'))
         doc_line_nums = pickle.load(open(save_dir + 'doc_line_nums.pickle', 'rb'))
         
+        # Corpora saved before the tokenizer could be chosen all used NLTK.
+        tokenizer = 'nltk'
+        if exists(save_dir + 'tokenizer.pickle'):
+            tokenizer = pickle.load(open(save_dir + 'tokenizer.pickle', 'rb'))
+        
+        line_offsets = None
+        if exists(save_dir + 'line_offsets.pickle'):
+            line_offsets = pickle.load(open(save_dir + 'line_offsets.pickle', 'rb'))
+        
+        stoplist = None
+        if exists(save_dir + 'stoplist.pickle'):
+            stoplist = pickle.load(open(save_dir + 'stoplist.pickle', 'rb'))
+        
+        # Load the inverted index if it was saved, otherwise it's rebuilt.
+        inverted_index = None
+        if exists(save_dir + 'documents.inverted'):
+            inverted_index = InvertedIndex.load(save_dir + 'documents.inverted', mmap=mmap)
+        
+        positional_index = None
+        if exists(save_dir + 'documents.positions'):
+            positional_index = PositionalIndex.load(save_dir + 'documents.positions', mmap=mmap)
+        
         ksearch = KeySearch(dictionary, tfidf_model, 
                             corpus_tfidf, titles, tagsToDocs,
-                            docsToTags, files, doc_line_nums) 
+                            docsToTags, files, doc_line_nums, 
+                            inverted_index, positional_index, line_offsets,
+                            tokenizer, stoplist) 
         
         return ksearch
             
\ No newline at end of file
@@ -0,0 +1,315 @@
+# -*- coding: utf-8 -*-
+"""
+This module provides a positional index over the corpus, for phrase and
+proximity queries.
+"""
+
+import numpy as np
+from os import remove
+from gensim import utils
+from searchutils import selectUintType, createArray, narrowArray
+
+
+class PositionalIndex(utils.SaveLoad):
+    """
+    PositionalIndex records where each word occurs within each document, so
+    that phrase ("blind from birth") and proximity ("blind" within 5 words of
+    "birth") queries can be answered without re-reading the source text.
+
+    A token's position is its index in the document after stop words have
+    been removed, so stop words are ignored when matching phrases.
+
+    The index is stored in three levels, all as flat numpy arrays:
+      * For each word, `doc_ptr` gives the range of `doc_ids` holding the
+        sorted ids of the documents which contain the word.
+      * For each of those (word, document) pairs, `pos_ptr` gives the range
+        of `positions` holding the positions of the word in the document.
+      * The positions of each pair are delta-encoded: the first is stored as
+        is, and each one after that as the gap from the previous one. The
+        gaps are small numbers, so `positions` is stored with the smallest
+        unsigned integer type which fits them all.
+
+    Like CsrCorpus, the arrays are saved as raw numpy files which can be
+    memory-mapped by `load`.
+    """
+    def __init__(self, doc_ids, doc_ptr, positions, pos_ptr):
+        self.doc_ids = doc_ids
+        self.doc_ptr = doc_ptr
+        self.positions = positions
+        self.pos_ptr = pos_ptr
+
+    @classmethod
+    def build(cls, documents, dictionary):
+        """
+        Build the index from `documents`, a list (or generator) of documents
+        represented as lists of tokens, in order. Tokens which aren't in the
+        gensim `dictionary` are skipped (but still take up a position).
+        """
+        token2id = dictionary.token2id
+
+        # Collect the word ids and positions of each document as small arrays
+        # (`documents` may be a generator, so it's only read once).
+        word_ids = []
+        doc_ids = []
+        positions = []
+
+        for (doc_id, doc) in enumerate(documents):
+            doc_word_ids = np.fromiter((token2id.get(token, -1) for token in doc),
+                                       dtype=np.int32, count=len(doc))
+
+            doc_positions = np.flatnonzero(doc_word_ids != -1)
+
+            word_ids.append(doc_word_ids[doc_positions])
+            doc_ids.append(np.repeat(np.int32(doc_id), len(doc_positions)))
+            positions.append(doc_positions.astype(np.int32))
+
+        word_ids = np.concatenate(word_ids + [np.zeros(0, dtype=np.int32)]).astype(np.int64)
+        doc_ids = np.concatenate(doc_ids + [np.zeros(0, dtype=np.int32)]).astype(np.int64)
+        positions = np.concatenate(positions + [np.zeros(0, dtype=np.int32)]).astype(np.int64)
+
+        # Sort the occurrences by word, then document, then position.
+        order = np.lexsort((positions, doc_ids, word_ids))
+        word_ids = word_ids[order]
+        doc_ids = doc_ids[order]
+        positions = positions[order]
+
+        # Find where each (word, document) pair begins.
+        pair_starts = np.ones(len(word_ids), dtype=bool)
+        pair_starts[1:] = (word_ids[1:] != word_ids[:-1]) | (doc_ids[1:] != doc_ids[:-1])
+        pair_starts = np.flatnonzero(pair_starts)
+
+        pos_ptr = np.append(pair_starts, len(word_ids)).astype(np.int64)
+
+        # Find where each word's pairs begin.
+        num_words = len(dictionary)
+        doc_ptr = np.searchsorted(word_ids[pair_starts], np.arange(num_words + 1)).astype(np.int64)
+
+        # Delta-encode the positions within each pair.
+        gaps = positions.copy()
+        gaps[1:] -= positions[:-1]
+        gaps[pair_starts] = positions[pair_starts]
+
+        # Store the gaps with the smallest type that fits.
+        max_gap = gaps.max() if len(gaps) else 0
+
+        return cls(doc_ids[pair_starts].astype(np.int32), doc_ptr, 
+                   gaps.astype(selectUintType(max_gap)), pos_ptr)
+
+    @classmethod
+    def buildOnDisk(cls, documents, dictionary, inverted_index, fname, block_size=4096):
+        """
+        Build the index like `build`, but without holding it in memory.
+
+        The (word, document) pairs of this index are exactly the postings of
+        an InvertedIndex built from the word counts of the same documents
+        (with term frequencies, see `InvertedIndex.buildOnDisk`), and the 
+        number of positions of each pair is its term frequency. So the layout
+        of the index is known up front: the doc ids and `doc_ptr` are shared
+        with `inverted_index`, and `pos_ptr` is the running sum of the term 
+        frequencies. The positions of each block of `block_size` documents 
+        are then written straight into their places in `positions`.
+
+        The arrays are created on disk as `fname`.pos_ptr.npy and 
+        `fname`.positions.npy, and the returned index holds them memory-
+        mapped, so they must be kept until the index has been saved 
+        elsewhere.
+        """
+        token2id = dictionary.token2id
+        doc_ptr = inverted_index.postings_ptr
+        pair_lens = inverted_index.term_freqs
+
+        # Find where the positions of each pair begin, taking the running sum
+        # a million pairs at a time.
+        pos_ptr = createArray(fname + '.pos_ptr.npy', np.int64, len(pair_lens) + 1)
+        step = 1048576
+        
+        for start in range(0, len(pair_lens), step):
+            totals = np.cumsum(pair_lens[start:start + step], dtype=np.int64)
+            pos_ptr[start + 1:start + 1 + len(totals)] = totals + pos_ptr[start]
+
+        # The gaps are written as uint32 first, then copied to the smallest 
+        # type that fits once the largest gap is known.
+        gaps = createArray(fname + '.positions.tmp.npy', np.uint32, pos_ptr[-1])
+        max_gap = 0
+
+        # Where the next position of each word goes.
+        next_position = np.array(pos_ptr[doc_ptr[0:len(doc_ptr) - 1]], dtype=np.int64)
+
+        first_doc = 0
+
+        for block in utils.grouper(documents, block_size):
+            # Collect the word ids and positions of the block's documents, the 
+            # same way as `build`.
+            word_ids = []
+            doc_ids = []
+            positions = []
+
+            for (i, doc) in enumerate(block):
+                doc_word_ids = np.fromiter((token2id.get(token, -1) for token in doc),
+                                           dtype=np.int32, count=len(doc))
+
+                doc_positions = np.flatnonzero(doc_word_ids != -1)
+
+                word_ids.append(doc_word_ids[doc_positions])
+                doc_ids.append(np.repeat(np.int32(first_doc + i), len(doc_positions)))
+                positions.append(doc_positions.astype(np.int32))
+
+            first_doc += len(block)
+
+            word_ids = np.concatenate(word_ids + [np.zeros(0, dtype=np.int32)]).astype(np.int64)
+            doc_ids = np.concatenate(doc_ids + [np.zeros(0, dtype=np.int32)]).astype(np.int64)
+            positions = np.concatenate(positions + [np.zeros(0, dtype=np.int32)]).astype(np.int64)
+
+            # Sort the occurrences by word, then document, then position.
+            order = np.lexsort((positions, doc_ids, word_ids))
+            word_ids = word_ids[order]
+            doc_ids = doc_ids[order]
+            positions = positions[order]
+
+            # Delta-encode the positions within each pair. A document is never
+            # split across blocks, so neither is a pair.
+            block_gaps = positions.copy()
+            block_gaps[1:] -= positions[:-1]
+            
+            pair_starts = np.ones(len(word_ids), dtype=bool)
+            pair_starts[1:] = (word_ids[1:] != word_ids[:-1]) | (doc_ids[1:] != doc_ids[:-1])
+            block_gaps[pair_starts] = positions[pair_starts]
+
+            # Find the start of each word's run, and the index of each position
+            # within its run.
+            run_starts = np.flatnonzero(np.append(True, word_ids[1:] != word_ids[:-1]))
+            run_lens = np.diff(np.append(run_starts, len(word_ids)))
+            ranks = np.arange(len(word_ids)) - np.repeat(run_starts, run_lens)
+
+            # Write the gaps into place.
+            gaps[next_position[word_ids] + ranks] = block_gaps
+
+            next_position[word_ids[run_starts]] += run_lens
+
+            if len(block_gaps):
+                max_gap = max(max_gap, block_gaps.max())
+
+        # Store the gaps with the smallest type that fits.
+        positions = narrowArray(gaps, max_gap, fname + '.positions.npy')
+        del gaps
+        remove(fname + '.positions.tmp.npy')
+
+        return cls(inverted_index.doc_ids, doc_ptr, positions, pos_ptr)
+
+    def getDocs(self, word_id):
+        """
+        Returns the sorted array of ids of the documents containing `word_id`.
+        """
+        return self.doc_ids[self.doc_ptr[word_id]:self.doc_ptr[word_id + 1]]
+
+    def getOccurrences(self, word_id, docs=None):
+        """
+        Returns every occurrence of `word_id` as a sorted array of keys, where
+        each key combines the doc id and the position as:
+            (doc_id << 32) + position
+
+        If `docs` (a sorted array of doc ids) is given, only the occurrences
+        in those documents are returned.
+        """
+        pair_start = self.doc_ptr[word_id]
+        pair_end = self.doc_ptr[word_id + 1]
+
+        # Decode all of the positions for this word at once: take the running
+        # sum of the gaps, then subtract the running total from before the
+        # start of each document.
+        pos_start = self.pos_ptr[pair_start]
+        totals = np.cumsum(self.positions[pos_start:self.pos_ptr[pair_end]], dtype=np.int64)
+
+        pair_lens = np.diff(self.pos_ptr[pair_start:pair_end + 1])
+        offsets = self.pos_ptr[pair_start:pair_end] - pos_start
+
+        before = np.zeros(len(offsets), dtype=np.int64)
+        before[1:] = totals[offsets[1:] - 1]
+
+        positions = totals - np.repeat(before, pair_lens)
+
+        keys = (np.repeat(self.getDocs(word_id).astype(np.int64), pair_lens) << 32) + positions
+
+        if docs is not None:
+            keys = keys[np.in1d(keys >> 32, docs)]
+
+        return keys
+
+    def searchPhrase(self, word_ids, docs=None):
+        """
+        Returns the sorted array of ids of the documents in which the words
+        `word_ids` occur next to each other, in order.
+
+        A word id of -1 is a gap in the phrase, which matches any word (this
+        is used for words which were left out of the dictionary, but still
+        take up a position).
+
+        `docs` optionally restricts the search to a sorted array of doc ids.
+        """
+        # Start with the rarest word, then check for each other word at the
+        # right offset from it.
+        order = sorted([i for i in range(0, len(word_ids)) if word_ids[i] != -1],
+                       key=lambda i: self.doc_ptr[word_ids[i] + 1] - self.doc_ptr[word_ids[i]])
+
+        if not order:
+            return np.zeros(0, dtype=np.int64)
+
+        first = order[0]
+        keys = self.getOccurrences(word_ids[first], docs)
+
+        # 'keys' holds the candidate positions of the start of the phrase.
+        keys = keys[(keys & 0xFFFFFFFF) >= first] - first
+
+        for i in order[1:]:
+            if len(keys) == 0:
+                break
+
+            occurrences = self.getOccurrences(word_ids[i], np.unique(keys >> 32))
+            keys = keys[np.in1d(keys + i, occurrences)]
+
+        return np.unique(keys >> 32)
+
+    def searchNear(self, word_id1, word_id2, max_distance, docs=None):
+        """
+        Returns the sorted array of ids of the documents in which `word_id1`
+        and `word_id2` occur within `max_distance` positions of each other
+        (in either order).
+
+        `docs` optionally restricts the search to a sorted array of doc ids.
+        """
+        keys1 = self.getOccurrences(word_id1, docs)
+
+        if len(keys1) == 0:
+            return np.zeros(0, dtype=np.int64)
+
+        # If both words are the same, each occurrence must be near another
+        # occurrence, not itself. The occurrences are sorted, so it's enough
+        # to check the gap to the next one in the same document.
+        if word_id1 == word_id2:
+            found = ((keys1[1:] >> 32) == (keys1[:-1] >> 32)) & \
+                    (keys1[1:] - keys1[:-1] <= max_distance)
+            
+            return np.unique(keys1[1:][found] >> 32)
+        
+        keys2 = self.getOccurrences(word_id2, np.unique(keys1 >> 32))
+
+        if len(keys2) == 0:
+            return np.zeros(0, dtype=np.int64)
+
+        # For each occurrence of word 1, find the first occurrence of word 2
+        # at or after 'max_distance' positions before it (but in the same
+        # document), and check whether it's within 'max_distance' after it.
+        lower = np.maximum(keys1 - max_distance, (keys1 >> 32) << 32)
+        nearest = np.searchsorted(keys2, lower)
+        nearest[nearest == len(keys2)] = len(keys2) - 1
+
+        found = (keys2[nearest] >= lower) & (keys2[nearest] <= keys1 + max_distance)
+
+        return np.unique(keys1[found] >> 32)
+
+    def save(self, fname):
+        """
+        Write the index to `fname`, with the arrays stored in separate files
+        so that they can be memory-mapped by `load`.
+        """
+        super(PositionalIndex, self).save(fname, sep_limit=0)
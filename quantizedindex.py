@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+"""
+This module provides a compressed copy of the LSI vectors for scoring
+queries with less memory than the full float32 index.
+"""
+
+import numpy as np
+from gensim import utils
+from searchutils import selectTopN
+
+
+class QuantizedIndex(utils.SaveLoad):
+    """
+    QuantizedIndex stores the LSI vectors in a compressed form, either:
+        'int8'    - Each vector is scaled so that its largest value maps to
+                    127, and rounded to 8-bit integers. The scale is stored
+                    per vector. This takes 1/4 of the memory of float32.
+        'float16' - Each vector is stored as half-precision floats. This takes
+                    1/2 of the memory of float32.
+
+    A query is first scored against all of the compressed vectors, which gives
+    approximate similarities. The top `num_candidates` documents are then
+    re-ranked using their exact vectors, so the final similarity values are
+    exact. Only the candidate rows of the exact vectors are read, so the full
+    index can stay on disk (memory-mapped) without being loaded into RAM.
+    """
+    def __init__(self, vectors, mode, codes, scales=None, num_candidates=100,
+                 block_size=65536):
+        """
+        Use `QuantizedIndex.build` to create a new index.
+
+        Parameters:
+            vectors - The (num_docs x num_topics) matrix of exact, normalized
+                      LSI vectors, used for re-ranking.
+            mode - 'int8' or 'float16'
+            codes - The compressed vectors.
+            scales - For 'int8', the scale of each vector.
+            num_candidates - The number of approximate results to re-rank.
+            block_size - Number of vectors to decompress at once when scoring.
+        """
+        self.vectors = vectors
+        self.mode = mode
+        self.codes = codes
+        self.scales = scales
+        self.num_candidates = num_candidates
+        self.block_size = block_size
+
+    @classmethod
+    def build(cls, vectors, mode='int8', num_candidates=100, block_size=65536):
+        """
+        Build a QuantizedIndex by compressing the normalized LSI `vectors`.
+        """
+        if mode == 'int8':
+            # Scale each vector so its largest magnitude value maps to 127.
+            scales = np.abs(vectors).max(axis=1) / 127.0
+            scales[scales == 0] = 1.0
+            scales = scales.astype(np.float32)
+
+            codes = np.round(vectors / scales.reshape(-1, 1)).astype(np.int8)
+        elif mode == 'float16':
+            scales = None
+            codes = vectors.astype(np.float16)
+        else:
+            raise ValueError('Unknown quantization mode: ' + mode)
+
+        return cls(vectors, mode, codes, scales, num_candidates, block_size)
+
+    def scoreApprox(self, query):
+        """
+        Returns the approximate similarity between `query` and every document.
+
+        The compressed vectors are converted back to float32 one block at a
+        time, so we never hold a full-size float32 copy of the index.
+        """
+        query = query.astype(np.float32)
+        sims = np.zeros(len(self.codes), dtype=np.float32)
+
+        for start in range(0, len(self.codes), self.block_size):
+            block = self.codes[start:start + self.block_size].astype(np.float32)
+            sims[start:start + self.block_size] = np.dot(block, query)
+
+        if self.mode == 'int8':
+            sims *= self.scales
+
+        return sims
+
+    def search(self, query, topn=10, exclude=None):
+        """
+        Find the `topn` most similar documents to the normalized LSI vector
+        `query`.
+
+        `exclude` is an optional boolean mask over all documents; documents
+        marked True will not be returned.
+
+        Returns the results as a list of tuples in the form:
+            (doc_id, similarity_value)
+        """
+        # Select the candidates using the approximate similarities.
+        num_candidates = max(topn, self.num_candidates)
+        approx = selectTopN(self.scoreApprox(query), num_candidates, exclude=exclude)
+
+        # Re-rank the candidates with their exact vectors. Keep the candidates
+        # in ascending order so that ties are still broken by doc_id.
+        candidates = np.sort([doc_id for (doc_id, sim) in approx]).astype(int)
+
+        if len(candidates) == 0:
+            return []
+
+        sims = np.dot(self.vectors[candidates], query)
+
+        return [(int(candidates[i]), sim) for (i, sim) in selectTopN(sims, topn)]
+
+    def getMemorySize(self):
+        """
+        Returns the number of bytes used by the compressed vectors.
+        """
+        num_bytes = self.codes.nbytes
+
+        if self.scales is not None:
+            num_bytes += self.scales.nbytes
+
+        return num_bytes
+
+    def save(self, fname):
+        """
+        Write the index to `fname`. The arrays are stored in separate files so
+        that they can be memory-mapped by `load`. The exact LSI vectors are
+        not included--they're saved with the SimSearch index.
+        """
+        super(QuantizedIndex, self).save(fname, sep_limit=0, ignore=['vectors'])
+
+    @classmethod
+    def load(cls, fname, vectors, mmap=None):
+        """
+        Load an index saved with `save`, attaching it to the exact LSI
+        `vectors`.
+
+        Pass mmap='r' to memory-map the arrays rather than reading them in.
+        """
+        quantized_index = super(QuantizedIndex, cls).load(fname, mmap=mmap)
+        quantized_index.vectors = vectors
+
+        return quantized_index
@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+"""
+This module provides a cache of search results for SimSearch.
+"""
+
+import hashlib
+from collections import OrderedDict
+
+import numpy as np
+from searchutils import selectTopN
+
+
+class QueryCache(object):
+    """
+    QueryCache stores the results of recent queries, so that repeated queries
+    can be answered without searching the index again.
+
+    Queries are identified by their tf-idf vectors rather than their text, so
+    queries which only differ in punctuation, case, or words which aren't in
+    the dictionary are recognized as the same query.
+
+    The cache holds at most `max_size` queries, and evicts the least recently
+    used query when it's full. If `store_scores` is True, the similarity to
+    every document is stored along with the results, so that later requests
+    for more results (for example, the next page) can be answered from the
+    cache too. Note that this takes 4 bytes per document for every query!
+
+    Use `getStats` to see the number of cache hits, misses, and evictions.
+    """
+    def __init__(self, max_size=1000, store_scores=False):
+        self.max_size = max_size
+        self.store_scores = store_scores
+
+        # Maps query keys to [num_results, results, scores], with the least
+        # recently used query first.
+        self.entries = OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def makeKey(self, input_tfidf):
+        """
+        Returns a hash of the tf-idf vector `input_tfidf` to use as its key.
+        """
+        input_tfidf = sorted(input_tfidf)
+
+        word_ids = np.asarray([word_id for (word_id, value) in input_tfidf], dtype=np.int64)
+        values = np.asarray([value for (word_id, value) in input_tfidf], dtype=np.float64)
+
+        return hashlib.sha1(word_ids.tostring() + values.tostring()).digest()
+
+    def lookup(self, input_tfidf, topn):
+        """
+        Returns the top N results for `input_tfidf` if they are cached, or
+        None if they aren't.
+        """
+        key = self.makeKey(input_tfidf)
+
+        if key not in self.entries:
+            self.misses += 1
+            return None
+
+        # Move the query to the end of the list, as the most recently used.
+        entry = self.entries.pop(key)
+        self.entries[key] = entry
+
+        (num_results, results, scores) = entry
+
+        # We can answer from the cache if we stored at least 'topn' results,
+        # or if we can select them from the stored scores.
+        if num_results >= topn:
+            self.hits += 1
+            return results[0:topn]
+        elif scores is not None:
+            self.hits += 1
+
+            entry[0] = topn
+            entry[1] = selectTopN(scores, topn)
+
+            return entry[1]
+        else:
+            self.misses += 1
+            return None
+
+    def store(self, input_tfidf, topn, results, scores=None):
+        """
+        Store the top N `results` for `input_tfidf`, and optionally the
+        similarity `scores` for all documents.
+        """
+        key = self.makeKey(input_tfidf)
+
+        if not self.store_scores:
+            scores = None
+
+        if key in self.entries:
+            del self.entries[key]
+
+        self.entries[key] = [topn, results, scores]
+
+        # Evict the least recently used queries.
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def clear(self):
+        """
+        Remove all of the cached queries. This must be done whenever the
+        index or the LSI model changes.
+        """
+        self.entries.clear()
+
+    def getStats(self):
+        """
+        Returns a dictionary with the cache statistics.
+        """
+        lookups = self.hits + self.misses
+
+        hit_rate = 0.0
+        if lookups > 0:
+            hit_rate = float(self.hits) / lookups
+
+        return {'size': len(self.entries), 'hits': self.hits, 'misses': self.misses,
+                'evictions': self.evictions, 'hit_rate': hit_rate}
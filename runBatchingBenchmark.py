@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+"""
+This script compares answering concurrent text queries one at a time against
+batching them with BatchSearch. For each number of concurrent clients, it
+reports the throughput (queries per second) and the p50 / p99 latencies.
+
+@author: Chris McCormick
+"""
+
+import random
+import threading
+import time
+
+from simsearch import SimSearch
+from batchsearch import BatchSearch
+
+# Number of seconds to run each test for.
+duration = 10.0
+
+# The numbers of concurrent clients to test.
+concurrency_levels = [1, 4, 16, 64]
+
+# Load the pre-built corpus.
+print('Loading the saved SimSearch and corpus...')
+(ksearch, ssearch) = SimSearch.load(save_dir='./mhc_corpus/')
+
+# Use the lines of 'input.txt' as the queries.
+with open('input.txt') as f:
+    queries = [line.strip() for line in f if line.strip()]
+
+
+def runTest(search_fn, concurrency):
+    """
+    Run `concurrency` client threads which call `search_fn` back-to-back for
+    `duration` seconds. Returns (queries per second, p50 ms, p99 ms).
+    """
+    latencies = []
+    stop_time = time.time() + duration
+
+    def runClient(seed):
+        rng = random.Random(seed)
+        while time.time() < stop_time:
+            t0 = time.time()
+            search_fn(rng.choice(queries))
+            latencies.append((time.time() - t0) * 1000.0)
+
+    clients = [threading.Thread(target=runClient, args=(i,)) for i in range(0, concurrency)]
+
+    t0 = time.time()
+    for client in clients:
+        client.start()
+    for client in clients:
+        client.join()
+    elapsed = time.time() - t0
+
+    latencies.sort()
+
+    return (len(latencies) / elapsed,
+            latencies[int(0.50 * (len(latencies) - 1))],
+            latencies[int(0.99 * (len(latencies) - 1))])
+
+
+print('')
+print('  clients   mode            QPS   p50 (ms)   p99 (ms)   avg batch')
+
+for concurrency in concurrency_levels:
+
+    # Unbatched: each client calls SimSearch directly.
+    (qps, p50, p99) = runTest(lambda text: ssearch.findSimilarToText(text, topn=10), concurrency)
+
+    print('  %7d   unbatched  %8.1f   %8.2f   %8.2f' % (concurrency, qps, p50, p99))
+
+    # Batched: the clients' queries are combined by BatchSearch.
+    bsearch = BatchSearch(ssearch, max_batch_size=64, max_latency_ms=5.0)
+
+    (qps, p50, p99) = runTest(lambda text: bsearch.search(text, topn=10), concurrency)
+
+    bsearch.close()
+
+    print('  %7d   batched    %8.1f   %8.2f   %8.2f   %9.1f' %
+          (concurrency, qps, p50, p99, float(bsearch.num_queries) / max(bsearch.num_batches, 1)))
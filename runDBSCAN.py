@@ -8,10 +8,9 @@ Created on Thu Dec 01 11:19:04 2016
 from simsearch import SimSearch
 from sklearn.cluster import DBSCAN
 import sklearn
+import numpy as np
 import time
 
-from sklearn.neighbors import NearestNeighbors
-
 
 def findEps(ssearch):
     """
@@ -21,21 +20,22 @@ def findEps(ssearch):
     # Calculate nearest neighbors
     ###########################################################################
     
-    # Create a nearest neighbors model--we need 2 nearest neighbors since the 
-    # nearest neighbor to a point is going to be itself.
-    nbrs_model = NearestNeighbors(n_neighbors=2, algorithm='brute', metric='cosine').fit(ssearch.index.index)
-    
+    # Use the precomputed nearest neighbor table if there is one, otherwise 
+    # find the single nearest neighbor (other than itself) of every document.
     t0 = time.time()
     
-    # Find nearest neighbors.
-    distances, indices = nbrs_model.kneighbors(ssearch.index.index)
+    if ssearch.neighbors is not None:
+        neighbors = ssearch.neighbors
+    else:
+        neighbors = ssearch.buildNeighborTable(k=1)
     
     elapsed = time.time() - t0
     
     print 'Took %.2f seconds' % elapsed
     
-    distances = [d[1] for d in distances]
-    indeces = [ind[1] for ind in indices]
+    # Convert the cosine similarities to cosine distances.
+    distances = 1.0 - neighbors['sim'][:, 0]
+    indeces = neighbors['id'][:, 0]
     
     ###########################################################################
     # Histogram the nearest neighbor distances.
@@ -148,19 +148,19 @@ def runClustering(ssearch, eps, min_samples):
     # Show the number of clusters (don't include noise label)
     print('Number of clusters (excluding "noise"): %d' % (len(cluster_ids) - 1))  
      
+    # Count the documents in each cluster.
+    (labels, counts) = np.unique(db.labels_, return_counts=True)
+    
+    # Get the top words in all of the clusters at once.
+    t0 = time.time()
+    
+    top_words = ssearch.getTopWordsInClusters(db.labels_)
+    
+    print("  Found top words in %.3fsec" % (time.time() - t0))
+    
     # For each of the clusters...    
-    for cluster_id in cluster_ids:
-            
-            # Get the list of all doc IDs belonging to this cluster.
-            cluster_doc_ids = []
-            for doc_id in range(0, len(db.labels_)):            
-                if db.labels_[doc_id] == cluster_id:
-                    cluster_doc_ids.append(doc_id)
-    
-            # Get the top words in this cluster
-            top_words = ssearch.getTopWordsInCluster(cluster_doc_ids)
-    
-            print('  Cluster %d: (%d docs) %s' % (cluster_id, len(cluster_doc_ids), " ".join(top_words)))
+    for (cluster_id, num_docs) in zip(labels, counts):
+        print('  Cluster %d: (%d docs) %s' % (cluster_id, num_docs, " ".join(top_words[cluster_id])))
         
 
 def main():   
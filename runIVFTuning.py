@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+"""
+This script builds an approximate IVF index over the MHC corpus, and measures
+the search speed and recall (relative to the exact search) for different
+values of `nprobe`--the number of clusters searched for each query.
+
+Pick the smallest `nprobe` with acceptable recall, then save the corpus to
+keep the index.
+
+@author: Chris McCormick
+"""
+
+from simsearch import SimSearch
+
+# Load the pre-built corpus.
+print('Loading the saved SimSearch and corpus...')
+(ksearch, ssearch) = SimSearch.load(save_dir='./mhc_corpus/')
+
+print('Building the IVF index...')
+ssearch.setIndexType('ivf', num_cells=256)
+
+# Measure the recall for a range of 'nprobe' values.
+for nprobe in [1, 2, 4, 8, 16, 32, 64]:
+    print('')
+    print('nprobe = %d' % nprobe)
+    
+    ssearch.ann_index.nprobe = nprobe
+    ssearch.measureRecall(num_queries=200, topn=10)
@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+"""
+This script measures the throughput (queries per second) and latency of a
+running query server (see simserver.py) at different levels of concurrency.
+
+Start the server first:
+
+    python simserver.py --save_dir ./mhc_corpus/ --port 8000
+
+Each concurrent client sends text queries (taken from the lines of
+'input.txt') and doc queries back-to-back for a fixed amount of time.
+
+@author: Chris McCormick
+"""
+
+import json
+import random
+import threading
+import time
+import urllib
+import urllib2
+
+# The address of the server to test.
+server_url = 'http://127.0.0.1:8000/'
+
+# Number of seconds to run each concurrency level for.
+duration = 10.0
+
+# The levels of concurrency to test.
+concurrency_levels = [1, 2, 4, 8, 16, 32]
+
+# Ask the server for the number of documents in the corpus, for choosing
+# random doc queries.
+num_docs = json.loads(urllib2.urlopen(server_url + 'stats').read())['num_docs']
+
+# Use the lines of 'input.txt' as the text queries.
+with open('input.txt') as f:
+    text_queries = [line.strip() for line in f if line.strip()]
+
+
+def runClient(latencies, errors, stop_time, seed):
+    """
+    Send queries until `stop_time`, appending each latency (in ms) to the
+    list `latencies`. Failed queries are appended to the list `errors` 
+    instead, and aren't counted in the throughput or latency.
+    """
+    rng = random.Random(seed)
+
+    while time.time() < stop_time:
+        # Alternate randomly between text and doc queries.
+        if rng.random() < 0.5:
+            url = server_url + 'text?' + urllib.urlencode({'q': rng.choice(text_queries)})
+        else:
+            url = server_url + 'doc?' + urllib.urlencode({'doc_id': rng.randint(0, num_docs - 1)})
+
+        t0 = time.time()
+        try:
+            urllib2.urlopen(url).read()
+        except (urllib2.HTTPError, urllib2.URLError) as e:
+            errors.append(str(e))
+            continue
+        latencies.append((time.time() - t0) * 1000.0)
+
+
+print('  clients       QPS   p50 (ms)   p99 (ms)   errors')
+
+for concurrency in concurrency_levels:
+    latencies = []
+    errors = []
+    stop_time = time.time() + duration
+
+    # Start the clients and wait for them to finish.
+    clients = [threading.Thread(target=runClient, args=(latencies, errors, stop_time, i))
+               for i in range(0, concurrency)]
+
+    t0 = time.time()
+    for client in clients:
+        client.start()
+    for client in clients:
+        client.join()
+    elapsed = time.time() - t0
+
+    # If every query failed, there are no latencies to report.
+    if not latencies:
+        print('  %7d  %8.1f   %8s   %8s   %6d' % (concurrency, 0.0, '-', '-', len(errors)))
+    else:
+        latencies.sort()
+        p50 = latencies[int(0.50 * (len(latencies) - 1))]
+        p99 = latencies[int(0.99 * (len(latencies) - 1))]
+
+        print('  %7d  %8.1f   %8.2f   %8.2f   %6d' % (concurrency, len(latencies) / elapsed,
+                                                     p50, p99, len(errors)))
+
+    # Show the first error, so that a failing setup is easy to spot.
+    if errors:
+        print('           first error: ' + errors[0])
+
+# Print the server's own counters.
+print('')
+print('Server statistics:')
+print(json.dumps(json.loads(urllib2.urlopen(server_url + 'stats').read()), indent=4))
@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+"""
+This script compares the compressed (quantized) index types against the
+exact index. For each type, it shows how much memory the vectors take and
+how closely the results match the exact search (recall@10).
+
+@author: Chris McCormick
+"""
+
+from simsearch import SimSearch
+
+# Load the pre-built corpus.
+print('Loading the saved SimSearch and corpus...')
+(ksearch, ssearch) = SimSearch.load(save_dir='./mhc_corpus/')
+
+exact_bytes = ssearch.index.index.nbytes
+
+print('')
+print('Exact index: %.1f MB' % (exact_bytes / 1e6))
+
+for index_type in ['float16', 'int8']:
+    
+    # Try a few different numbers of candidates to re-rank.
+    for num_candidates in [10, 50, 100, 500]:
+        
+        ssearch.setIndexType(index_type, num_candidates=num_candidates)
+        
+        num_bytes = ssearch.ann_index.getMemorySize()
+        
+        print('')
+        print('%s index, re-ranking %d candidates: %.1f MB (%.0f%% of exact)' % 
+              (index_type, num_candidates, num_bytes / 1e6, 100.0 * num_bytes / exact_bytes))
+        
+        ssearch.measureRecall(num_queries=200, topn=10)
@@ -23,6 +23,15 @@ print('Loading the saved SimSearch and corpus...')
 includes=['blind', 'birth']
 excludes=['samson']
 
+# Optional phrases which must appear word-for-word, and pairs of words which
+# must appear within some number of words of each other.
+phrases=[]
+near=[]
+
+# Set this to True to order the results by BM25 score (using the included 
+# words as the query), rather than by document id.
+ranked=True
+
 ###############################################################################
 # Perform the search
 ###############################################################################
@@ -30,9 +39,22 @@ excludes=['samson']
 print 'Performing keyword search...'
 print '    Including: %s' % ', '.join(includes)
 print '    Excluding: %s' % ', '.join(excludes)
+if phrases:
+    print '    Phrases: %s' % ', '.join(phrases)
 
 # Perform the search.
-results = ksearch.keywordSearch(includes=includes, excludes=excludes, docs=[])
+if ranked:
+    # Use the included words as the query, with any wildcards expanded to
+    # the words they match.
+    query = [(word_id, 1) for word in includes for word_id in ksearch.expandWord(word.lower())]
+
+    # Rank all of the documents which pass the filters.
+    results = ksearch.rankedSearch(query, topn=None, includes=includes, 
+                                   excludes=excludes, phrases=phrases, near=near)
+    results = [doc_id for (doc_id, score) in results]
+else:
+    results = ksearch.keywordSearch(includes=includes, excludes=excludes, docs=[],
+                                    phrases=phrases, near=near)
 
 ###############################################################################
 # Display results.
@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+"""
+This script measures the speed, in tokens per second, of each of the
+tokenizers in tokenizer.py, on the Matthew Henry's Commentary text (in
+./mhc/, the same text parsed by parseMHC.py).
+
+It also measures the time to convert short query texts (the lines of
+'input.txt') to tf-idf vectors with each tokenizer, since tokenizing is
+the slowest step of a text query.
+
+@author: Chris McCormick
+"""
+
+import time
+from os import listdir
+
+from simsearch import SimSearch
+from tokenizer import TOKENIZERS
+
+# The directory of text files to tokenize.
+text_dir = './mhc/'
+
+# Read all of the lines of text up front, so that only the tokenizing is
+# timed.
+lines = []
+for filename in sorted(listdir(text_dir)):
+    if filename.endswith('.txt'):
+        with open(text_dir + filename) as f:
+            lines.extend([line.decode('utf-8').replace('\n', ' ').lower() for line in f])
+
+print 'Tokenizing %d lines of text...\n' % len(lines)
+print '  tokenizer      tokens     seconds    tokens/sec'
+
+for name in sorted(TOKENIZERS.keys()):
+    tokenize = TOKENIZERS[name]
+
+    t0 = time.time()
+
+    num_tokens = 0
+    for line in lines:
+        num_tokens += len(tokenize(line))
+
+    elapsed = time.time() - t0
+
+    print '  %9s  %10d  %10.2f  %12.0f' % (name, num_tokens, elapsed, num_tokens / elapsed)
+
+# Time converting query text to tf-idf.
+print '\nLoading the saved SimSearch and corpus...'
+(ksearch, ssearch) = SimSearch.load(save_dir='./mhc_corpus/')
+
+with open('input.txt') as f:
+    queries = [line.strip() for line in f if line.strip()]
+
+print '\n  tokenizer   ms per query'
+
+for name in sorted(TOKENIZERS.keys()):
+    ksearch.tokenizer = name
+
+    t0 = time.time()
+
+    for query in queries:
+        ksearch.getTfidfForText(query)
+
+    print '  %9s   %12.3f' % (name, (time.time() - t0) * 1000.0 / len(queries))
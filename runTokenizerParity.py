@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+"""
+This script checks how closely the fast 'regex' tokenizer agrees with NLTK,
+by tokenizing every line of the Matthew Henry's Commentary text (in ./mhc/,
+the same text parsed by parseMHC.py) with both.
+
+It reports the fraction of lines which are tokenized identically, and the
+fraction of NLTK's tokens which the regex tokenizer also produces--both for
+all tokens, and for just the tokens which survive the stop word filter
+(which is what actually ends up in the dictionary). It then lists the most
+common tokens that the two disagree on.
+
+@author: Chris McCormick
+"""
+
+from collections import Counter
+from os import listdir
+
+from tokenizer import nltkTokenize, regexTokenize
+
+# The directory of text files to compare on.
+text_dir = './mhc/'
+
+# Read the stop words, which are filtered out of the corpus.
+with open('stop_words_mhc.txt') as f:
+    stoplist = set([line.decode('utf-8') for line in f.read().splitlines()])
+
+num_lines = 0
+num_same = 0
+
+# Total token counts, and the counts of tokens found by both.
+total = Counter()
+matched = Counter()
+
+# Tokens which only one of the tokenizers produced.
+only_nltk = Counter()
+only_regex = Counter()
+
+for filename in sorted(listdir(text_dir)):
+    if not filename.endswith('.txt'):
+        continue
+
+    print 'Comparing on', filename
+
+    with open(text_dir + filename) as f:
+        for line in f:
+            line = line.decode('utf-8').replace('\n', ' ').lower()
+
+            nltk_tokens = Counter(nltkTokenize(line))
+            regex_tokens = Counter(regexTokenize(line))
+
+            num_lines += 1
+            if nltk_tokens == regex_tokens:
+                num_same += 1
+
+            both = nltk_tokens & regex_tokens
+
+            total['all'] += sum(nltk_tokens.values())
+            matched['all'] += sum(both.values())
+
+            total['filtered'] += sum([c for (t, c) in nltk_tokens.items() if t not in stoplist])
+            matched['filtered'] += sum([c for (t, c) in both.items() if t not in stoplist])
+
+            only_nltk.update(nltk_tokens - regex_tokens)
+            only_regex.update(regex_tokens - nltk_tokens)
+
+print ''
+print 'Lines tokenized identically: %.2f%% of %d' % (100.0 * num_same / max(num_lines, 1), num_lines)
+print 'Token agreement (all tokens):      %.3f%%' % (100.0 * matched['all'] / max(total['all'], 1))
+print 'Token agreement (after stop list): %.3f%%' % (100.0 * matched['filtered'] / max(total['filtered'], 1))
+
+print '\nMost common tokens produced only by NLTK:'
+for (token, count) in only_nltk.most_common(20):
+    print '  %20s  %d' % (token.encode('utf-8'), count)
+
+print '\nMost common tokens produced only by the regex tokenizer:'
+for (token, count) in only_regex.most_common(20):
+    print '  %20s  %d' % (token.encode('utf-8'), count)
@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+"""
+Helper functions shared by the different search indexes.
+"""
+
+import numpy as np
+
+
+def selectTopN(sims, topn, exclude=None):
+    """
+    Select the `topn` largest values from the array of similarities `sims`,
+    without sorting the entire array.
+    
+    np.argpartition finds the top N candidates in linear time, and then only
+    those N candidates are sorted. Ties are broken by doc_id, so the results
+    are in exactly the same order as a full stable sort would produce.
+    
+    `exclude` is an optional boolean mask with one entry per document. Any
+    document marked True will not be returned.
+    
+    Returns the results as a list of tuples in the form:
+        (doc_id, similarity_value)
+    """
+    num_docs = len(sims)
+    num_valid = num_docs
+    
+    # Give the excluded documents a similarity of -inf so that they can't be
+    # selected, and don't ask for more results than there are valid docs.
+    if exclude is not None:
+        sims = np.where(exclude, -np.inf, sims).astype(sims.dtype)
+        num_valid -= np.count_nonzero(exclude)
+    
+    topn = min(topn, num_valid)
+    
+    if topn <= 0:
+        return []
+    
+    # Find the N largest values. np.argpartition only guarantees that the 
+    # value at position 'topn - 1' is in its sorted position, so gather every
+    # value which ties with the smallest of the winners--this way, ties at the
+    # cut-off are resolved by doc_id rather than arbitrarily.
+    if topn < num_docs:
+        winners = np.argpartition(-sims, topn - 1)[0:topn]
+        cutoff = sims[winners].min()
+        candidates = np.flatnonzero(sims >= cutoff)
+    else:
+        candidates = np.arange(num_docs)
+    
+    # Sort just the candidates, largest to smallest, breaking ties by doc_id.
+    order = np.lexsort((candidates, -sims[candidates]))
+    top_ids = candidates[order[0:topn]]
+    
+    return [(int(doc_id), sims[doc_id]) for doc_id in top_ids]
+
+
+def selectUintType(max_value):
+    """
+    Returns the smallest unsigned integer type which can hold `max_value`.
+    """
+    for dtype in [np.uint8, np.uint16, np.uint32]:
+        if max_value <= np.iinfo(dtype).max:
+            return dtype
+    
+    return np.uint64
+
+
+def createArray(fname, dtype, length):
+    """
+    Create the .npy file `fname` holding an array of `length` zeros, and 
+    return it memory-mapped for reading and writing. This is used to build
+    arrays which are too large to hold in memory.
+    """
+    return np.lib.format.open_memmap(fname, mode='w+', dtype=dtype, shape=(int(length),))
+
+
+def narrowArray(array, max_value, fname, block_size=1048576):
+    """
+    Copy the memory-mapped array of unsigned integers `array` into a new 
+    .npy file `fname`, using the smallest type which can hold `max_value` 
+    (the largest value in the array). The copy is made `block_size` values
+    at a time, and is returned memory-mapped.
+    """
+    narrowed = createArray(fname, selectUintType(max_value), len(array))
+    
+    for start in range(0, len(array), block_size):
+        narrowed[start:start + block_size] = array[start:start + block_size]
+    
+    return narrowed
@@ -0,0 +1,291 @@
+# -*- coding: utf-8 -*-
+"""
+This module splits the LSI index into shards, so that a corpus doesn't need
+to fit in the memory of a single process.
+"""
+
+import itertools
+import pickle
+import shutil
+import tempfile
+from multiprocessing import Pool
+from os import makedirs
+from os.path import exists, realpath
+
+import numpy as np
+from gensim import similarities
+from searchutils import selectTopN
+
+
+# The shard vectors held by each worker process, set by `initWorker`.
+worker_shards = None
+
+
+def initWorker(shard_files):
+    """
+    Initializes a worker process by memory-mapping the saved shards listed in
+    `shard_files`, so that all of the workers share the OS page cache.
+    """
+    global worker_shards
+
+    worker_shards = [similarities.MatrixSimilarity.load(shard_file, mmap='r').index
+                     for shard_file in shard_files]
+
+
+def searchShard(args):
+    """
+    Worker function which compares a batch of queries to a single shard.
+
+    The excluded doc ids must be given relative to the start of the shard.
+    The results are returned with local doc ids.
+    """
+    (shard_num, queries, topn, excludes) = args
+
+    vectors = worker_shards[shard_num]
+
+    sims = np.dot(queries, vectors.T)
+
+    results = []
+
+    for i in range(0, len(queries)):
+        exclude = None
+
+        if len(excludes[i]) > 0:
+            exclude = np.zeros(len(vectors), dtype=bool)
+            exclude[excludes[i]] = True
+
+        results.append(selectTopN(sims[i], topn, exclude=exclude))
+
+    return results
+
+
+class ShardedIndex(object):
+    """
+    ShardedIndex splits the LSI index into several shards, each holding the
+    vectors for a contiguous range of doc ids. Every shard is its own gensim
+    MatrixSimilarity, saved in its own subdirectory of the save directory,
+    with a manifest recording the doc id range of each shard.
+
+    Queries are compared against all of the shards in parallel by a pool of
+    worker processes, each of which memory-maps the saved shards. The top N
+    results from each shard are then merged. Since every document is scored
+    exactly, the results are the same as searching one unsharded index.
+
+    The shards are always on disk: `build` writes each shard out as soon as
+    it's built (to a temporary directory, until the index is saved), so the
+    full index is never held in memory.
+    """
+    def __init__(self, shards, offsets, shard_dirs, num_workers=None, temp_dir=None):
+        """
+        Use `ShardedIndex.build` or `ShardedIndex.load` to create an index.
+
+        Parameters:
+            shards - List of MatrixSimilarity objects, one per shard.
+            offsets - Shard `i` holds doc ids offsets[i] to offsets[i + 1] - 1.
+            shard_dirs - The directory each shard is saved in.
+            num_workers - Number of worker processes (default: one per shard)
+            temp_dir - The temporary directory holding the shards, if they
+                       haven't been saved yet. It's deleted by `save` and 
+                       `delete`.
+        """
+        self.shards = shards
+        self.offsets = np.asarray(offsets)
+        self.shard_dirs = shard_dirs
+        self.num_workers = num_workers or len(shards)
+        self.temp_dir = temp_dir
+
+        # The worker pool is started on the first search.
+        self.pool = None
+
+    @classmethod
+    def build(cls, lsi_corpus, num_docs, num_features, num_shards=4, num_workers=None,
+              temp_dir=None):
+        """
+        Build the shards from `lsi_corpus`, a corpus of LSI vectors with
+        `num_docs` documents.
+
+        The corpus is read through once, with each shard taking the next
+        range of documents. Each shard is written to disk as soon as it's 
+        built, and then memory-mapped, so only one shard is held in memory
+        at a time. The shards are written to a new temporary directory, which
+        is created inside `temp_dir` if it's given (otherwise, in the system
+        default location).
+        """
+        offsets = np.linspace(0, num_docs, num_shards + 1).astype(np.int64)
+
+        temp_dir = tempfile.mkdtemp(prefix='shards-', dir=temp_dir) + '/'
+
+        lsi_vecs = iter(lsi_corpus)
+
+        shards = []
+        shard_dirs = []
+        for i in range(0, num_shards):
+            shard_len = offsets[i + 1] - offsets[i]
+
+            shard = similarities.MatrixSimilarity(itertools.islice(lsi_vecs, shard_len),
+                                                  num_features=num_features,
+                                                  corpus_len=shard_len)
+
+            shard_dir = temp_dir + 'shard-%03d/' % i
+            makedirs(shard_dir)
+            shard.save(shard_dir + 'index.mm', sep_limit=0)
+            del shard
+
+            shards.append(similarities.MatrixSimilarity.load(shard_dir + 'index.mm', mmap='r'))
+            shard_dirs.append(shard_dir)
+
+        return cls(shards, offsets, shard_dirs, num_workers, temp_dir)
+
+    def getNumDocs(self):
+        """
+        Returns the total number of documents in all of the shards.
+        """
+        return int(self.offsets[-1])
+
+    def getVectors(self, doc_ids):
+        """
+        Returns the LSI vectors for the specified documents, as the rows of a
+        matrix.
+        """
+        doc_ids = np.asarray(doc_ids, dtype=np.int64)
+
+        # Find the shard which holds each document.
+        shard_nums = np.searchsorted(self.offsets, doc_ids, side='right') - 1
+
+        vectors = np.zeros((len(doc_ids), self.shards[0].index.shape[1]), dtype=np.float32)
+
+        for shard_num in np.unique(shard_nums):
+            rows = np.flatnonzero(shard_nums == shard_num)
+            local_ids = doc_ids[rows] - self.offsets[shard_num]
+            vectors[rows] = self.shards[shard_num].index[local_ids]
+
+        return vectors
+
+    def startWorkers(self):
+        """
+        Start the pool of worker processes, which memory-map the shards.
+        """
+        shard_files = [shard_dir + 'index.mm' for shard_dir in self.shard_dirs]
+
+        self.pool = Pool(self.num_workers, initializer=initWorker, initargs=(shard_files,))
+
+    def close(self):
+        """
+        Shut down the worker processes.
+        """
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+    def delete(self):
+        """
+        Shut down the worker processes, and delete the shards if they're only
+        in a temporary directory. The index can't be used after this.
+        """
+        self.close()
+
+        if self.temp_dir is not None:
+            shutil.rmtree(self.temp_dir, ignore_errors=True)
+            self.temp_dir = None
+
+    def searchBatch(self, queries, topn=10, excludes=None):
+        """
+        Find the `topn` most similar documents to each of the normalized LSI
+        vectors in `queries` (the rows of a matrix).
+
+        `excludes` optionally gives, for each query, an array of doc ids which
+        should not be returned for that query.
+
+        Returns one list of results for each query. Each list of results is in
+        the form:
+            (doc_id, similarity_value)
+        """
+        if self.pool is None:
+            self.startWorkers()
+
+        if excludes is None:
+            excludes = [np.zeros(0, dtype=np.int64)] * len(queries)
+
+        # Build the task for each shard, with the excluded ids converted to
+        # shard-local ids.
+        tasks = []
+        for shard_num in range(0, len(self.shards)):
+            start = self.offsets[shard_num]
+            end = self.offsets[shard_num + 1]
+
+            shard_excludes = [ids[(ids >= start) & (ids < end)] - start for ids in excludes]
+
+            tasks.append((shard_num, queries, topn, shard_excludes))
+
+        # Search all of the shards in parallel.
+        shard_results = self.pool.map(searchShard, tasks)
+
+        # Merge the results from the shards, converting to global doc ids.
+        # Ties are broken by doc id, the same as in `selectTopN`.
+        results = []
+        for i in range(0, len(queries)):
+            merged = []
+            for shard_num in range(0, len(self.shards)):
+                start = self.offsets[shard_num]
+                merged.extend([(int(start + doc_id), sim) for (doc_id, sim) in shard_results[shard_num][i]])
+
+            merged.sort(key=lambda item: (-item[1], item[0]))
+            results.append(merged[0:topn])
+
+        return results
+
+    def save(self, save_dir='./'):
+        """
+        Save each shard to its own subdirectory of `save_dir`, and write a
+        manifest listing the shards and their doc id ranges.
+
+        The shards never change once built, so if they're already saved in 
+        `save_dir`, they aren't written again. (Overwriting them would break
+        the workers which have them memory-mapped.)
+        """
+        shard_names = ['shard-%03d/' % shard_num for shard_num in range(0, len(self.shards))]
+        new_dirs = [save_dir + shard_name for shard_name in shard_names]
+
+        if [realpath(d) for d in new_dirs] == [realpath(d) for d in self.shard_dirs]:
+            new_dirs = self.shard_dirs
+        else:
+            for shard_num in range(0, len(self.shards)):
+                if not exists(new_dirs[shard_num]):
+                    makedirs(new_dirs[shard_num])
+
+                self.shards[shard_num].save(new_dirs[shard_num] + 'index.mm', sep_limit=0)
+
+        manifest = {'shards': shard_names, 'offsets': self.offsets,
+                    'num_workers': self.num_workers}
+        pickle.dump(manifest, open(save_dir + 'shards-manifest.pickle', 'wb'))
+
+        # Switch over to the saved shards, so that the temporary ones can be
+        # deleted. The workers are restarted to memory-map the saved shards.
+        if new_dirs is not self.shard_dirs:
+            self.close()
+            self.shards = [similarities.MatrixSimilarity.load(shard_dir + 'index.mm', mmap='r')
+                           for shard_dir in new_dirs]
+            self.shard_dirs = new_dirs
+
+        if self.temp_dir is not None:
+            shutil.rmtree(self.temp_dir, ignore_errors=True)
+            self.temp_dir = None
+
+    @classmethod
+    def load(cls, save_dir='./', mmap=None):
+        """
+        Load the shards listed in the manifest in `save_dir`. 
+        
+        Pass mmap='r' to memory-map the shards in this process, rather than 
+        reading them in (they're only used here by `getVectors`). The worker
+        processes always memory-map them.
+        """
+        manifest = pickle.load(open(save_dir + 'shards-manifest.pickle', 'rb'))
+
+        shard_dirs = [save_dir + shard_name for shard_name in manifest['shards']]
+
+        shards = [similarities.MatrixSimilarity.load(shard_dir + 'index.mm', mmap=mmap)
+                  for shard_dir in shard_dirs]
+
+        return cls(shards, manifest['offsets'], shard_dirs, manifest['num_workers'])
@@ -6,9 +6,20 @@ Created on Fri Oct 14 21:00:58 2016
 """
 
 from gensim.models import LsiModel
-from gensim import similarities
+from gensim import similarities, matutils
 from keysearch import KeySearch
+from ivfindex import IVFIndex
+from quantizedindex import QuantizedIndex
+from querycache import QueryCache
+from shardedindex import ShardedIndex
+from multiprocessing.pool import ThreadPool
+from scipy import sparse
+from os.path import exists, realpath
+from os import remove
+from searchutils import selectTopN
 import numpy as np
+import pickle
+import time
 
 class SimSearch(object):
     """
@@ -32,11 +43,32 @@ class SimSearch(object):
         
         """        
         self.ksearch = key_search
+        
+        # Cache of the summed LSI vectors for each tag, see `getTagCentroid`.
+        self.tag_centroids = {}
+        
+        # Optional table of each document's nearest neighbors, see 
+        # `buildNeighborTable`.
+        self.neighbors = None
+        
+        # By default, queries are compared against every document in the
+        # index. See `setIndexType` for the approximate alternatives.
+        self.index_type = 'exact'
+        self.ann_index = None
+        
+        # Optional cache of query results, see `enableCache`.
+        self.cache = None
+        
+        # The directory this was memory-mapped from by `load`, if any.
+        self.mmap_dir = None
            
 
-    def trainLSI(self, num_topics=100):
+    def trainLSI(self, num_topics=100, index_type='exact', **index_params):
         """
         Train the Latent Semantic Indexing model.
+        
+        `index_type` selects how queries are compared against the corpus, see
+        `setIndexType`. Any additional parameters are passed on to the index.
         """
         self.num_topics = num_topics        
         # Train LSA
@@ -45,9 +77,205 @@ class SimSearch(object):
         #self.num_tfidf_features = max(self.corpus_tfidf.dfs) + 1        
         
         self.lsi = LsiModel(self.ksearch.corpus_tfidf, num_topics=self.num_topics, id2word=self.ksearch.dictionary)   
+        
+        # Project the tf-idf matrix onto the LSI space, a block of rows at a
+        # time, rather than transforming the documents one by one.
+        lsi_vecs = self.projectCorpus()
+    
+        # Close down the workers of any previous sharded index, and delete its
+        # shards if they were never saved.
+        if self.index_type == 'sharded':
+            self.ann_index.delete()
+        
+        # Transform corpus to LSI space and index it. A sharded index is 
+        # built directly from the corpus, writing each shard to disk as it
+        # goes, so that the full index never has to be held in memory.
+        if index_type == 'sharded':
+            self.index = None
+            self.ann_index = ShardedIndex.build(lsi_vecs, 
+                                                len(self.ksearch.corpus_tfidf),
+                                                num_topics, **index_params)
+            self.index_type = index_type
+        else:
+            self.index = similarities.MatrixSimilarity(lsi_vecs, num_features=num_topics,
+                                                       corpus_len=len(self.ksearch.corpus_tfidf)) 
+            
+            # Build the approximate index, if one was requested.
+            self.setIndexType(index_type, **index_params)
+    
+        # The tag centroids depend on the index, so rebuild them.
+        self.buildTagCentroids()
+        
+        # Any nearest neighbor table is now out of date.
+        self.neighbors = None
+        
+        # As are any cached query results.
+        if self.cache is not None:
+            self.cache.clear()
+    
+    def enableCache(self, max_size=1000, store_scores=False):
+        """
+        Cache the results of queries made through `findSimilarToVector` 
+        (which includes `findSimilarToText` and `findSimilarToFile`) and 
+        `findSimilarBatch`, so that repeated queries don't search the index
+        again. See QueryCache for the parameters.
+        
+        The cache is cleared whenever the LSI model is retrained or the index
+        type is changed. Use `self.cache.getStats()` to see how well it's 
+        working.
+        """
+        self.cache = QueryCache(max_size, store_scores)
+    
+    def disableCache(self):
+        """
+        Stop caching query results.
+        """
+        self.cache = None
+    
+    def setIndexType(self, index_type, **index_params):
+        """
+        Select how queries are compared against the corpus:
+            'exact' - Compare the query to every document in the index.
+            'ivf'   - Only compare the query to the documents in the nearest
+                      clusters, using an IVFIndex. This is approximate. 
+                      Parameters: num_cells, nprobe
+            'int8', 'float16' - Compare the query to compressed copies of 
+                      the vectors, then re-rank the best candidates exactly,
+                      using a QuantizedIndex. The full index is only used for
+                      re-ranking, so consider loading a corpus saved with one
+                      of these with mmap='r'.
+                      Parameters: num_candidates
+        
+        Use `measureRecall` to check how closely an approximate index matches
+        the exact results.
+        
+        There is also a 'sharded' index type, which splits the index into 
+        shards that are searched in parallel by worker processes (see 
+        ShardedIndex). It has to be selected when calling `trainLSI`.
+        Parameters: num_shards, num_workers, temp_dir (where the shards are
+        kept until the index is saved)
+        """
+        if self.index is None:
+            raise ValueError('The index type of a sharded corpus can\'t be changed.')
+        
+        if index_type == 'exact':
+            self.ann_index = None
+        elif index_type == 'ivf':
+            self.ann_index = IVFIndex.build(self.index.index, **index_params)
+        elif index_type in ['int8', 'float16']:
+            self.ann_index = QuantizedIndex.build(self.index.index, mode=index_type, **index_params)
+        else:
+            raise ValueError('Unknown index type: ' + index_type)
+        
+        self.index_type = index_type
+        
+        # The nearest neighbor table was built with the old index.
+        self.neighbors = None
+        
+        # The cached results may not match the new index type.
+        if self.cache is not None:
+            self.cache.clear()
+    
+    def searchVectors(self, lsi_vecs, topn=10, exclude=None, self_ids=None, exact=False):
+        """
+        Find the documents most similar to each of the normalized LSI vectors
+        in `lsi_vecs` (the rows of a matrix), using the selected index type.
+        
+        `exclude` is an optional boolean mask over all documents; documents
+        marked True will not be returned. `self_ids` optionally gives a doc id
+        for each query to exclude from that query's results only.
+        
+        Pass exact=True to compare the queries to the full index even if an
+        approximate index type is selected. (The sharded index is always 
+        exact.)
+        
+        Returns one list of results for each query vector. Each list of 
+        results is in the form:
+            (doc_id, similarity_value)
+        """
+        # The sharded index searches all of the queries at once, with the 
+        # documents to exclude from each query given by id.
+        if self.index_type == 'sharded':
+            exclude_ids = np.zeros(0, dtype=np.int64)
+            if exclude is not None:
+                exclude_ids = np.flatnonzero(exclude)
+            
+            excludes = [exclude_ids] * len(lsi_vecs)
+            if self_ids is not None:
+                excludes = [np.append(exclude_ids, doc_id) for doc_id in self_ids]
+            
+            return self.ann_index.searchBatch(lsi_vecs, topn, excludes)
+        
+        # Make a copy of the exclude mask that we can add the self ids to.
+        if self_ids is not None:
+            if exclude is None:
+                exclude = np.zeros(self.getNumDocs(), dtype=bool)
+            else:
+                exclude = exclude.copy()
+        
+        # For the exact search, compare all of the queries to the entire 
+        # collection at once.
+        use_ann = (self.ann_index is not None) and not exact
+        
+        if not use_ann:
+            sims = np.dot(lsi_vecs, self.index.index.T)
+        
+        results = []
+        
+        for i in range(0, len(lsi_vecs)):
+            if self_ids is not None:
+                exclude[self_ids[i]] = True
+            
+            if not use_ann:
+                results.append(selectTopN(sims[i], topn, exclude=exclude))
+            else:
+                results.append(self.ann_index.search(lsi_vecs[i], topn, exclude=exclude))
+            
+            if self_ids is not None:
+                exclude[self_ids[i]] = False
+        
+        return results
     
-        # Transform corpus to LSI space and index it
-        self.index = similarities.MatrixSimilarity(self.lsi[self.ksearch.corpus_tfidf], num_features=num_topics) 
+    def measureRecall(self, num_queries=100, topn=10, seed=0):
+        """
+        Measure how well the approximate index agrees with the exact search.
+        
+        Randomly selected documents from the corpus are used as queries. The
+        recall@topn is the fraction of the exact top N results that the 
+        approximate index also returns, averaged over the queries.
+        
+        Prints and returns the recall.
+        """
+        if self.index is None:
+            raise ValueError('The sharded index is exact; there is no recall to measure.')
+        
+        # Select the query documents.
+        rng = np.random.RandomState(seed)
+        doc_ids = rng.permutation(len(self.index.index))[0:num_queries]
+        queries = self.index.index[doc_ids]
+        
+        # Run the queries one at a time against the selected index.
+        t0 = time.time()
+        approx_results = [self.searchVectors(query.reshape(1, -1), topn)[0] for query in queries]
+        approx_time = time.time() - t0
+        
+        # Run the queries one at a time with an exact search.
+        t0 = time.time()
+        exact_results = [selectTopN(np.dot(self.index.index, query), topn) for query in queries]
+        exact_time = time.time() - t0
+        
+        # Count how many of the exact results were found.
+        found = 0
+        for (approx, exact) in zip(approx_results, exact_results):
+            found += len(set([r[0] for r in approx]) & set([r[0] for r in exact]))
+        
+        recall = float(found) / (len(doc_ids) * topn)
+        
+        print 'Recall@%d (%s index): %.3f' % (topn, self.index_type, recall)
+        print '  %.2f ms per query vs. %.2f ms for exact search' % \
+            (approx_time * 1000.0 / len(doc_ids), exact_time * 1000.0 / len(doc_ids))
+        
+        return recall
     
     
     def findSimilarToVector(self, input_tfidf, topn=10, in_corpus=False):
@@ -56,24 +284,39 @@ class SimSearch(object):
         represented by its tf-idf vector 'input_tfidf'.
         """
         
-        # Find the most similar entries to the input tf-idf vector.
-        #  1. Project it onto the LSI vector space.
-        #  2. Compare the LSI vector to the entire collection.
-        sims = self.index[self.lsi[input_tfidf]]        
+        # If the input vector exists in the corpus, we'll skip the first 
+        # result since this will just be the document itself.
+        if in_corpus:
+            num_results = topn + 1
+        else:
+            num_results = topn
+        
+        # Check for the results in the cache.
+        results = None
+        if self.cache is not None:
+            results = self.cache.lookup(input_tfidf, num_results)
+        
+        if results is None:
+            # Find the most similar entries to the input tf-idf vector.
+            #  1. Project it onto the LSI vector space.
+            #  2. Compare the LSI vector to the entire collection.
+            lsi_vecs = self.projectLSI([input_tfidf])
+            
+            # Select just the top N results, sorted from largest to smallest.
+            # If the cache stores the full similarity scores, we need to 
+            # calculate those first (only possible with the exact index).
+            scores = None
+            if (self.cache is not None) and self.cache.store_scores and (self.index_type == 'exact'):
+                scores = np.dot(self.index.index, lsi_vecs[0])
+                results = selectTopN(scores, num_results)
+            else:
+                results = self.searchVectors(lsi_vecs, num_results)[0]
+            
+            if self.cache is not None:
+                self.cache.store(input_tfidf, num_results, results, scores)
         
-        # Sort the similarities from largest to smallest.
-        # 'sims' becomes a list of tuples of the form: 
-        #    (doc_id, similarity_value)
-        sims = sorted(enumerate(sims), key=lambda item: -item[1])   
-
-        # Select just the top N results.
-        # If the input vector exists in the corpus, skip the first one since
-        # this will just be the document itself.
         if in_corpus:        
-            # Select just the top N results, skipping the first one.
-            results = sims[1:1 + topn]    
-        else:
-            results = sims[0:topn] 
+            results = results[1:]
                     
         return results
     
@@ -81,43 +324,139 @@ class SimSearch(object):
         """
         Find documents similar to a collection of input vectors.        
         
-        Combines the similarity scores from multiple query vectors.
+        Combines the similarity scores from multiple query vectors. Documents
+        in `exclude_ids` are not returned.
+        
+        Returns the results as a list of tuples in the form:
+            (doc_id, summed_similarity_value)
         """
-        # Calculate the combined similarities for all input vectors.
-        sims_sum = []
+        # Project all of the input vectors onto the LSI space at once.
+        lsi_vecs = self.projectLSI(input_tfidfs)
         
-        for input_vec in input_tfidfs:
-            
-            # Calculate the similarities between this and all other entries.
-            sims = self.index[self.lsi[input_vec]]
+        # The LSI vectors are normalized, so the sum of the similarities to
+        # each input vector is the same as the similarity to the sum of the
+        # input vectors. That means we only need to scan the index once.
+        lsi_sum = lsi_vecs.sum(axis=0).reshape(1, -1)
         
-            # Accumulate the similarities across all input vectors.
-            if len(sims_sum) == 0:
-                sims_sum = sims
-            else:
-                sims_sum = np.sum([sims, sims_sum], axis=0)
-                    
-        # Sort the combined similarities.
-        sims_sum = sorted(enumerate(sims_sum), key=lambda item: -item[1])
+        # Select the top results, skipping any in the exclude list.
+        return self.searchVectors(lsi_sum, topn, exclude=self.getExcludeMask(exclude_ids))[0]
+   
+    def getNumDocs(self):
+        """
+        Returns the number of documents in the index.
+        """
+        if self.index_type == 'sharded':
+            return self.ann_index.getNumDocs()
+        else:
+            return len(self.index.index)
+    
+    def getDocVectors(self, doc_ids):
+        """
+        Returns the stored (normalized) LSI vectors for the specified 
+        documents, as the rows of a matrix.
+        """
+        if self.index_type == 'sharded':
+            return self.ann_index.getVectors(doc_ids)
+        else:
+            return self.index.index[doc_ids]
+    
+    def getExcludeMask(self, exclude_ids):
+        """
+        Create a boolean mask over all of the documents in the index, with
+        the documents in `exclude_ids` marked True.
+        """
+        mask = np.zeros(self.getNumDocs(), dtype=bool)
+        mask[np.asarray(list(exclude_ids), dtype=int)] = True
+        return mask
+    
+    def projectLSI(self, input_tfidfs):
+        """
+        Project a list of tf-idf vectors onto the LSI vector space all at once.
+        
+        This performs the same projection as `self.lsi[vec]`, but for all of
+        the input vectors in a single sparse-dense matrix multiply. The LSI 
+        vectors are normalized (just like the vectors in the index) and 
+        returned as the rows of a dense (num_vectors x num_topics) matrix.
+        """
+        # Stack the sparse tf-idf vectors as the columns of a sparse matrix.
+        tfidf_mat = matutils.corpus2csc(input_tfidfs, num_terms=self.lsi.num_terms,
+                                        num_docs=len(input_tfidfs))
+        
+        return self.projectRows(tfidf_mat.T)
+    
+    def projectRows(self, tfidf_mat):
+        """
+        Project the rows of the sparse (num_vectors x vocab_size) tf-idf 
+        matrix `tfidf_mat` onto the LSI vector space. The normalized LSI 
+        vectors are returned as the rows of a dense matrix.
+        """
+        # Project all of the vectors onto the LSI space.
+        lsi_vecs = tfidf_mat.dot(self.lsi.projection.u[:, 0:self.lsi.num_topics])
+        lsi_vecs = np.asarray(lsi_vecs, dtype=np.float32)
+        
+        # Normalize the vectors. Vectors with no known words are left as all
+        # zeros.
+        norms = np.linalg.norm(lsi_vecs, axis=1)
+        norms[norms == 0] = 1.0
+        lsi_vecs /= norms.reshape(-1, 1)
+        
+        return lsi_vecs
 
-        # Look through the results until we've gathered 'topn' results.
-        results = []      
-        for i in range(0, len(sims_sum)):
-            
-            # Get the doc id for this result.
-            doc_id = sims_sum[i][0]    
+    def projectCorpus(self, block_size=4096):
+        """
+        Generator which yields the normalized LSI vector for every document in
+        the corpus, in order.
         
-            # If the result is not one of the inputs, and not in the exclude 
-            # list, it's a valid result.
-            if doc_id not in exclude_ids:
-                results.append(sims_sum[i])
+        The rows of the tf-idf matrix are projected `block_size` at a time, 
+        so only one block of LSI vectors is held in memory at once.
+        """
+        tfidf = self.ksearch.getTfidfMatrix()
+        
+        for start in range(0, tfidf.shape[0], block_size):
+            for lsi_vec in self.projectRows(tfidf[start:start + block_size]):
+                yield lsi_vec
 
-            # Break when we've gathered 'topn' results.
-            if len(results) == topn:
-                break
+    def findSimilarBatch(self, input_tfidfs, topn=10, chunksize=256):
+        """
+        Find the documents most similar to each of the tf-idf vectors in 
+        `input_tfidfs`.
+        
+        All of the queries are projected onto the LSI space together, and 
+        compared to the entire collection with one matrix multiply, which is
+        much faster than issuing the queries one at a time. The queries are
+        processed in groups of `chunksize` to limit the size of the 
+        (queries x documents) similarity matrix.
+        
+        Returns one list of results for each input vector. Each list of 
+        results is in the form:
+            (doc_id, similarity_value)
+        """
+        # Look up any queries which are already in the cache.
+        if self.cache is not None:
+            results = [self.cache.lookup(input_tfidf, topn) for input_tfidf in input_tfidfs]
+        else:
+            results = [None] * len(input_tfidfs)
+        
+        # Search for the remaining queries.
+        misses = [i for i in range(0, len(input_tfidfs)) if results[i] is None]
+        
+        for start in range(0, len(misses), chunksize):
+            chunk = misses[start:start + chunksize]
+            
+            # Project this group of queries onto the LSI space.
+            lsi_vecs = self.projectLSI([input_tfidfs[i] for i in chunk])
+            
+            # Compare all of the queries to the collection at once, and select
+            # the top N results for each.
+            chunk_results = self.searchVectors(lsi_vecs, topn)
+            
+            for (i, query_results) in zip(chunk, chunk_results):
+                results[i] = query_results
                 
+                if self.cache is not None:
+                    self.cache.store(input_tfidfs[i], topn, query_results)
+        
         return results
-   
     
     def findSimilarToText(self, text, topn=10):
         """
@@ -136,6 +475,50 @@ class SimSearch(object):
         # Pass the call down.        
         return self.findSimilarToVector(tfidf_vec, topn=topn, in_corpus=False)
     
+    def findSimilarWithKeywords(self, text, includes=[], excludes=[], topn=10, 
+                                docs=[], phrases=[], near=[], max_gather=0.05):
+        """
+        Find documents in the corpus similar to the provided input text, but
+        only among the documents which pass a keyword search. The keyword 
+        filters are the same as for `KeySearch.keywordSearch`.
+        
+        The keyword search is done first, using the inverted index. If it 
+        leaves no more than `max_gather` (as a fraction) of the corpus, just
+        those documents' vectors are gathered from the index and compared to
+        the query. Otherwise, the query is compared to the whole index as 
+        usual, with the other documents masked out. This way a very selective
+        filter makes the query faster rather than slower.
+        
+        Returns the results as a list of tuples in the form:
+            (doc_id, similarity_value)
+        """
+        # Find the documents which pass the keyword filters.
+        candidates = np.asarray(self.ksearch.keywordSearch(includes, excludes, docs, 
+                                                           phrases, near), dtype=np.int64)
+        candidates = np.unique(candidates)
+        
+        # If nothing passed the filters, there's nothing to rank.
+        if len(candidates) == 0:
+            return []
+        
+        # Parse the input text and project it onto the LSI space.
+        lsi_vecs = self.projectLSI([self.ksearch.getTfidfForText(text)])
+        
+        num_docs = self.getNumDocs()
+        
+        if len(candidates) <= max_gather * num_docs:
+            # Compare the query to just the candidate documents.
+            sims = np.dot(self.getDocVectors(candidates), lsi_vecs[0])
+            
+            return [(int(candidates[i]), sim) for (i, sim) in selectTopN(sims, topn)]
+        else:
+            # Compare the query to everything, but exclude the documents which
+            # didn't pass the filters.
+            exclude = np.ones(num_docs, dtype=bool)
+            exclude[candidates] = False
+            
+            return self.searchVectors(lsi_vecs, topn, exclude=exclude)[0]
+    
     def findSimilarToFile(self, filename, topn=10):
         """
         Find documents in the corpus similar to the provided text file.
@@ -163,17 +546,91 @@ class SimSearch(object):
             (doc_id, similarity_value)
         """
         
-        # Find the most similar entries to 'doc_id'
-        #  1. Look up the tf-idf vector for the entry.
-        #  2. Project it onto the LSI vector space.
-        #  3. Compare the LSI vector to the entire collection.
-        tfidf_vec = self.ksearch.corpus_tfidf[doc_id]
+        # Pass the call down.
+        return self.findSimilarToDocs([doc_id], topn=topn)[0]
+    
+    def findSimilarToDocs(self, doc_ids, topn=10, chunksize=256):
+        """
+        Find documents similar to each of the specified entries in the corpus.
+        
+        The LSI vectors for documents in the corpus are already stored 
+        (normalized) in the index, so they are read straight from the index
+        rather than re-projecting their tf-idf vectors. All of the documents 
+        in a group of `chunksize` are compared to the collection with a 
+        single matrix multiply.
+        
+        The input documents will not appear in their own results lists.
+        
+        Returns one list of results for each input document. Each list of 
+        results is in the form:
+            (doc_id, similarity_value)
+        """
+        # If the nearest neighbors have been precomputed, just look them up.
+        if (self.neighbors is not None) and (topn <= self.neighbors.shape[1]):
+            return [[(int(nbr['id']), nbr['sim']) for nbr in self.neighbors[doc_id][0:topn]]
+                    for doc_id in doc_ids]
+        
+        results = []
         
-        # Pass the call down, specifying that the input is a part of the 
-        # corpus.
-        return self.findSimilarToVector(tfidf_vec, topn=topn, in_corpus=True)    
+        for start in range(0, len(doc_ids), chunksize):
+            chunk_ids = doc_ids[start:start + chunksize]
+            
+            # Look up the stored LSI vectors and compare them to the 
+            # collection, skipping each document in its own results.
+            lsi_vecs = self.getDocVectors(chunk_ids)
+            results.extend(self.searchVectors(lsi_vecs, topn, self_ids=chunk_ids))
         
+        return results
     
+    def buildNeighborTable(self, k=10, block_size=256, num_workers=4):
+        """
+        Precompute the `k` nearest neighbors of every document in the corpus,
+        so that `findSimilarToDocs` becomes a table lookup (for `topn` <= k).
+        
+        The documents are compared to the whole collection in blocks of 
+        `block_size` documents, with the blocks spread over `num_workers` 
+        threads (numpy releases the GIL during the 
+        matrix multiplies). Each thread holds one (block_size x num_docs) 
+        block of similarities, which bounds the memory used.
+        
+        The table is always built with an exact search, since an approximate
+        index may find fewer than `k` neighbors for some documents.
+        
+        The table is stored as a (num_docs x k) array of (id, sim) records, 
+        and is returned as well as stored in `self.neighbors`. It is saved 
+        by `save` as 'neighbors.npy', and memory-mapped by `load` with 
+        mmap='r'.
+        """
+        num_docs = self.getNumDocs()
+        
+        # A document can't be its own neighbor.
+        k = min(k, num_docs - 1)
+        
+        neighbors = np.zeros((num_docs, k), dtype=[('id', np.int32), ('sim', np.float32)])
+        
+        def findBlockNeighbors(start):
+            block_ids = range(start, min(start + block_size, num_docs))
+            
+            # Compare this block of documents to the collection, skipping 
+            # each document in its own results.
+            results = self.searchVectors(self.getDocVectors(block_ids), k, self_ids=block_ids,
+                                         exact=True)
+            
+            for (doc_id, top) in zip(block_ids, results):
+                neighbors[doc_id]['id'] = [nbr[0] for nbr in top]
+                neighbors[doc_id]['sim'] = [nbr[1] for nbr in top]
+        
+        pool = ThreadPool(num_workers)
+        try:
+            pool.map(findBlockNeighbors, range(0, num_docs, block_size))
+        finally:
+            pool.close()
+            pool.join()
+        
+        self.neighbors = neighbors
+        
+        return neighbors
+        
     def findMoreOfTag(self, tag, topn=10):
         """
         Find entries in the corpus which are similar to those tagged with 
@@ -187,44 +644,62 @@ class SimSearch(object):
         
         # I pre-pend a '!' to indicate that a document does not belong under
         # a specific tag (I do this to create negative samples)
-        if ('!' + tag) in self.ksearch.tagsToEntries:
-            exclude_ids = set(self.ksearch.tagsToEntries['!' + tag])
+        if ('!' + tag) in self.ksearch.tagsToDocs:
+            exclude_ids = set(self.ksearch.tagsToDocs['!' + tag])
         else:
             exclude_ids = set()
         
         # Find all documents marked with 'tag'.
-        input_ids = self.ksearch.tagsToEntries[tag]
+        input_ids = self.ksearch.tagsToDocs[tag]
         
-        # Calculate the combined similarities for all input vectors.
-        sims_sum = []
+        # Append the input ids to the list of those to exclude from the results
+        exclude_ids.update(input_ids)
+
+        # The summed similarity to all of the tagged documents is just the
+        # similarity to the sum of their (normalized) LSI vectors.
+        centroid = self.getTagCentroid(tag).reshape(1, -1)
         
-        for i in input_ids:
-            # Get the LSI vector for this document.    
-            input_vec = self.lsi[self.ksearch.corpus_tfidf[i]]
+        # Select the top results, skipping the tagged documents.
+        return self.searchVectors(centroid, topn, exclude=self.getExcludeMask(exclude_ids))[0]
         
-            print '  ' + self.ksearch.titles[i]
+    def getTagCentroid(self, tag):
+        """
+        Returns the sum of the LSI vectors for all of the documents tagged
+        with `tag`.
         
-            # Calculate the similarities between this and all other entries.
-            sims = self.index[input_vec]
+        The centroids are cached along with the list of documents they were
+        calculated from. If the documents under a tag have changed since the 
+        centroid was calculated, the centroid is recalculated.
+        """
+        doc_ids = tuple(self.ksearch.tagsToDocs[tag])
         
-            # Accumulate the similarities across all input vectors.
-            if len(sims_sum) == 0:
-                sims_sum = sims
-            else:
-                sims_sum = np.sum([sims, sims_sum], axis=0)
-                    
-        # Sort the combined similarities.
-        sims_sum = sorted(enumerate(sims_sum), key=lambda item: -item[1])    
+        # Use the cached centroid if the tag's documents haven't changed.
+        if tag in self.tag_centroids:
+            (cached_ids, centroid) = self.tag_centroids[tag]
+            
+            if cached_ids == doc_ids:
+                return centroid
         
-        # Append the input ids to the list of those to exclude from the results
-        exclude_ids = exclude_ids + input_ids
-
-        # Lookup the vectors for all of the input docs.        
-        input_vecs = [self.ksearch.getTfidfForDoc(doc_id) for doc_id in input_ids]
+        # Sum the LSI vectors for the tagged documents, straight from the 
+        # index.
+        centroid = self.getDocVectors(list(doc_ids)).sum(axis=0)
+        self.tag_centroids[tag] = (doc_ids, centroid)
         
-        # Pass the call down.
-        return self.findSimilarToVecs(input_vecs, exclude_ids=exclude_ids, topn=topn)
+        return centroid
+    
+    def buildTagCentroids(self):
+        """
+        Calculate the centroids for all of the tags in the corpus.
         
+        Negative tags (tags starting with '!') are only used to exclude 
+        documents, so no centroid is needed for them.
+        """
+        self.tag_centroids = {}
+        
+        for tag in self.ksearch.tagsToDocs:
+            if not tag.startswith('!'):
+                self.getTagCentroid(tag)
+    
     def sparseToDense(self, sparse_vec, length):
         """
         Convert from a sparse vector representation to a dense vector. 
@@ -244,39 +719,90 @@ class SimSearch(object):
         return vec
 
 
+    def getWordProjections(self, vec_tfidf):
+        """
+        Returns the word ids and tf-idf values from the sparse tf-idf vector 
+        `vec_tfidf` as arrays, along with the rows of the LSI projection 
+        matrix for just those words.
+        """
+        word_ids = np.asarray([word_id for (word_id, value) in vec_tfidf], dtype=int)
+        values = np.asarray([value for (word_id, value) in vec_tfidf], dtype=np.float64)
+        
+        # Gather the topic weights for the words in this document. Each row
+        # has one weight for each topic.
+        word_weights = self.lsi.projection.u[word_ids, 0:self.lsi.num_topics]
+        
+        return (word_ids, values, word_weights)
+    
+    def sortWordSims(self, word_ids, word_sims):
+        """
+        Sort the per-word similarity contributions, biggest to smallest, and
+        return them as a list of tuples in the form:
+            (word_id, sim_value)
+        """
+        order = np.lexsort((word_ids, -word_sims))
+        
+        return [(int(word_ids[i]), float(word_sims[i])) for i in order]
+    
     def getSimilarityByWord(self, vec1_tfidf, vec2_tfidf):
         """
         Calculates the individual contribution of each word in document 1 to
         the total similarity between documents 1 and 2.
         
-        Returns a list of tuples in the form:
+        Only the words which appear in document 1 are considered (all other 
+        words contribute nothing).
+        
+        Returns a list of tuples, sorted by sim_value (biggest to smallest),
+        in the form:
             (word_id, sim_value)
         """    
-        # Get the tf-idf and LSI vectors for the two documents, and convert them to
-        # dense representations.        
-        vec1_lsi = self.sparseToDense(self.lsi[vec1_tfidf], self.lsi.num_topics)
-        vec2_lsi = self.sparseToDense(self.lsi[vec2_tfidf], self.lsi.num_topics)
-        vec1_tfidf = self.sparseToDense(vec1_tfidf, self.ksearch.getVocabSize())
-        #vec2_tfidf = self.sparseToDense(self.ksearch.corpus_tfidf[id2], self.ksearch.getVocabSize())    
+        # Get the tf-idf values and topic weights for the words in each doc.
+        (word_ids, values1, word_weights1) = self.getWordProjections(vec1_tfidf)
+        (_, values2, word_weights2) = self.getWordProjections(vec2_tfidf)
+        
+        # Project the two documents onto the LSI space.
+        vec1_lsi = np.dot(values1, word_weights1)
+        vec2_lsi = np.dot(values2, word_weights2)
 
         # Calculate the norms of the two LSI vectors.
         norms = np.linalg.norm(vec1_lsi) * np.linalg.norm(vec2_lsi)    
-                
-        # Create a vector to hold the similarity contribution of each word.
-        word_sims = np.zeros(self.ksearch.getVocabSize())
-
-        # For each word in the vocabulary...
-        for word_id in range(0, self.ksearch.getVocabSize()):
-
-            # Get the weights vector for this word. This vector has one weight
-            # for each topic
-            word_weights = np.asarray(self.lsi.projection.u[word_id, :]).flatten()
-
-            # Calculate the contribution of this word in doc1 to the total similarity.
-            word_sims[word_id] = vec1_tfidf[word_id] * np.dot(word_weights, vec2_lsi) / norms;
+        
+        # Calculate the contribution of each word in doc1 to the total 
+        # similarity. (The contributions sum to the cosine similarity.)
+        if norms == 0:
+            word_sims = np.zeros(len(word_ids))
+        else:
+            word_sims = values1 * np.dot(word_weights1, vec2_lsi) / norms
           
-        # print 'Total word contributions:', np.sum(word_sims)  
-        return word_sims
+        return self.sortWordSims(word_ids, word_sims)
+
+    def getSimilarityByWordBatch(self, vec1_tfidf, doc_ids):
+        """
+        Calculates the individual contribution of each word in document 1 to
+        its similarity with each of the documents in the corpus listed in 
+        `doc_ids`--for example, all of the results of a search.
+        
+        The stored (normalized) LSI vectors of the corpus documents are used,
+        so the contributions for all of the documents are calculated with a
+        single matrix multiply.
+        
+        Returns one list of tuples for each document in `doc_ids`, in the same
+        form as `getSimilarityByWord`.
+        """
+        (word_ids, values1, word_weights1) = self.getWordProjections(vec1_tfidf)
+        
+        # Project document 1 onto the LSI space.
+        norm1 = np.linalg.norm(np.dot(values1, word_weights1))
+        
+        # Calculate the contributions for all of the documents at once, giving
+        # a (num_words x num_docs) matrix.
+        if norm1 == 0:
+            word_sims = np.zeros((len(word_ids), len(doc_ids)))
+        else:
+            doc_vecs = self.getDocVectors(doc_ids)
+            word_sims = values1.reshape(-1, 1) * np.dot(word_weights1, doc_vecs.T) / norm1
+        
+        return [self.sortWordSims(word_ids, word_sims[:, i]) for i in range(0, len(doc_ids))]
 
     def printWordSims(self, word_sims, topn, min_pos, max_neg):
         """
@@ -289,7 +815,7 @@ class SimSearch(object):
         
         # Build up the table of results to display.        
         tableStr = ''
-        for i in range(0, topn):
+        for i in range(0, min(topn, len(word_sims))):
             pos_word_id, pos_word_val = word_sims[i]
             neg_word_id, neg_word_val = word_sims[-(i + 1)]
             
@@ -332,56 +858,100 @@ class SimSearch(object):
         
         """
 
-        # Calculate the contribution of each word in doc 1 to the similarity.        
+        # Calculate the contribution of each word in doc 1 to the similarity,
+        # sorted biggest to smallest.
         word_sims = self.getSimilarityByWord(vec1_tfidf, vec2_tfidf)
         
-        # Sort the similarities, biggest to smallest.    
-        word_sims = sorted(enumerate(word_sims), key=lambda item: -item[1])
-
         print 'Words in doc 1 which contribute most to similarity:'
         self.printWordSims(word_sims, topn, min_pos, max_neg)
 
         # Calculate the contribution of each word in doc 2 to the similarity.
         word_sims = self.getSimilarityByWord(vec2_tfidf, vec1_tfidf)
         
-        # Sort the similarities, biggest to smallest.    
-        word_sims = sorted(enumerate(word_sims), key=lambda item: -item[1])
-
         print 'Words in doc 2 which contribute most to similarity:'
         self.printWordSims(word_sims, topn, min_pos, max_neg)
     
+    def interpretResults(self, input_tfidf, results, topn=10, min_pos=0.1, max_neg=-0.01):
+        """
+        Displays the words in the query `input_tfidf` which contribute the
+        most to its similarity with each of the search `results`, calculated
+        for all of the results at once.
+        
+        The parameters are the same as for `interpretMatch`.
+        """
+        doc_ids = [doc_id for (doc_id, sim) in results]
+        
+        all_word_sims = self.getSimilarityByWordBatch(input_tfidf, doc_ids)
+        
+        for (doc_id, word_sims) in zip(doc_ids, all_word_sims):
+            print 'Words in the query which contribute most to similarity with doc %d:' % doc_id
+            self.printWordSims(word_sims, topn, min_pos, max_neg)
+    
 
     def getTopWordsInCluster(self, doc_ids, topn=10):
         """
         Returns the most significant words in a specified group of documents.
         
         This is accomplished by summing together the tf-idf vectors for all the
-        documents, then sorting the tf-idf values in descending order.
+        documents, then selecting the words with the largest tf-idf sums.
         """
-        # Create a vector to hold the sum
-        tfidf_sum = np.zeros(self.ksearch.getVocabSize())
+        # Sum the rows of the tf-idf matrix for the documents in the group.
+        tfidf_sum = self.ksearch.getTfidfMatrix()[list(doc_ids)].sum(axis=0)
+        tfidf_sum = np.asarray(tfidf_sum, dtype=np.float64).ravel()
         
-        for doc_id in doc_ids:
-            
-            # Get the tf-idf vector for this document, and convert it to
-            # its dense representation.
-            vec_tfidf = self.ksearch.getTfidfForDoc(doc_id)
-            vec_tfidf = self.sparseToDense(vec_tfidf, self.ksearch.getVocabSize())
-            
-            # Add the tf-idf vector to the sum.
-            tfidf_sum += vec_tfidf
-
-        # Sort the per-word tf-idf values, biggest to smallest.    
-        word_ids = sorted(enumerate(tfidf_sum), key=lambda item: -item[1])
+        # Select the top words, biggest to smallest.
+        top_ids = selectTopN(tfidf_sum, topn)
         
         # Create a list of the top words (as strings)
-        top_words = []        
-        for i in range(0, topn):
-            word_id = word_ids[i][0]
-            top_words.append(self.ksearch.dictionary[word_id])
+        return [self.ksearch.dictionary[word_id] for (word_id, value) in top_ids]
+    
+    def getTopWordsInClusters(self, labels, topn=10):
+        """
+        Returns the most significant words in every cluster at once.
+        
+        `labels` gives the cluster id of each document in the corpus (for 
+        example, the `labels_` from a fitted sklearn DBSCAN).
+        
+        Rather than summing up the documents of one cluster at a time, this 
+        builds a sparse (num_clusters x num_docs) membership matrix and 
+        multiplies it with the tf-idf matrix, giving the tf-idf sums for all 
+        of the clusters in one pass over the corpus. Only the words which 
+        actually appear in a cluster are considered when selecting its top 
+        words.
+        
+        Returns a dictionary mapping each cluster id to its list of top words 
+        (as strings).
+        """
+        tfidf = self.ksearch.getTfidfMatrix()
+        
+        # Map the cluster ids to row numbers 0 to (num_clusters - 1).
+        (cluster_ids, rows) = np.unique(np.asarray(labels), return_inverse=True)
+        
+        num_docs = len(rows)
+        
+        # Each column of the membership matrix has a single 1, in the row of 
+        # the cluster that the document belongs to.
+        membership = sparse.csr_matrix((np.ones(num_docs), (rows, np.arange(num_docs))),
+                                       shape=(len(cluster_ids), num_docs))
+        
+        # Calculate the tf-idf sums for all of the clusters.
+        tfidf_sums = membership.dot(tfidf).tocsr()
+        tfidf_sums.sort_indices()
+        
+        top_words = {}
+        
+        for i in range(0, len(cluster_ids)):
+            start = tfidf_sums.indptr[i]
+            end = tfidf_sums.indptr[i + 1]
             
-        return top_words
+            # Select the top words from just the non-zero sums.
+            word_ids = tfidf_sums.indices[start:end]
+            top_ids = selectTopN(tfidf_sums.data[start:end], topn)
+            
+            top_words[cluster_ids[i].item()] = [self.ksearch.dictionary[word_ids[j]] 
+                                                for (j, value) in top_ids]
         
+        return top_words
 
     def printResultsByTitle(self, results):
         """
@@ -416,6 +986,10 @@ class SimSearch(object):
         text.
         """
         print 'Most similar documents:\n'
+        
+        # Read the source text for all of the results at once.
+        sources = self.ksearch.readDocSources([doc_id for (doc_id, sim) in results])
+        
         for i in range(0, len(results)):            
             # Print the similarity value followed by the source file and line
             # numbers.            
@@ -424,7 +998,7 @@ class SimSearch(object):
             print '  %.2f    %s  Lines: %d - %d' % (results[i][1], line_nums[0], line_nums[1], line_nums[2])
 
             # Call down to the CorpusBuilder to print out the doc.
-            self.ksearch.printDocSourcePretty(results[i][0], max_lines)
+            self.ksearch.printDocSourcePretty(results[i][0], max_lines, lines=sources[i])
             
             # Separate the results with a line.
             if len(results) > 1:
@@ -438,33 +1012,99 @@ class SimSearch(object):
         Save this SimSearch object to disk for later use.
         
         This also saves the underlying CorpusBuilder object to disk.
+        
+        A SimSearch which was loaded with mmap='r' can't be saved back to the 
+        same directory, since that would overwrite the files it's reading.
         """
+        if (self.mmap_dir is not None) and (realpath(save_dir) == realpath(self.mmap_dir)):
+            raise ValueError('Can\'t save over the memory-mapped files this was loaded from: ' +
+                             save_dir)
+
+        # Save the LSI model and the LSI index. All of the arrays are stored
+        # in separate files so that they can be memory-mapped by `load`.
+        # A sharded index is saved as one subdirectory per shard instead.
+        if self.index_type == 'sharded':
+            self.ann_index.save(save_dir)
+        else:
+            self.index.save(save_dir + 'index.mm', sep_limit=0)
+        
+        self.lsi.save(save_dir + 'lsi.model', sep_limit=0)
 
-        # Save the LSI model and the LSI index.        
-        self.index.save(save_dir + 'index.mm')
-        self.lsi.save(save_dir + 'lsi.model')
+        # Save the tag centroids.
+        pickle.dump(self.tag_centroids, open(save_dir + 'tag-centroids.pickle', 'wb'))
+
+        # Save the nearest neighbor table, if it's been built. Otherwise, 
+        # remove any table left from an earlier save, since it would no longer
+        # match the model.
+        if self.neighbors is not None:
+            np.save(save_dir + 'neighbors.npy', self.neighbors)
+        elif exists(save_dir + 'neighbors.npy'):
+            remove(save_dir + 'neighbors.npy')
+        
+        # Save the index type, and the approximate index if there is one.
+        pickle.dump(self.index_type, open(save_dir + 'index-type.pickle', 'wb'))
+        
+        if self.index_type == 'ivf':
+            self.ann_index.save(save_dir + 'ivf.index')
+        elif self.index_type in ['int8', 'float16']:
+            self.ann_index.save(save_dir + 'quantized.index')
 
         # Save the underlying CorpusBuilder as well.        
         self.ksearch.save(save_dir)
         
     @classmethod
-    def load(cls, save_dir='./'):
+    def load(cls, save_dir='./', mmap=None):
         """
         Load a SimSearch object and it's underlying KeySearch from the 
         specified directory. Returns both objects.
+        
+        Pass mmap='r' to memory-map the large arrays (the index, the LSI 
+        projection, and the tf-idf corpus) read-only, rather than reading 
+        them into memory. Loading is then nearly instant, and multiple worker
+        processes on the same machine share one copy of the arrays through 
+        the OS page cache.
         """
         
         # First create and load the underlying KeySearch.
-        ksearch = KeySearch.load(save_dir)
+        ksearch = KeySearch.load(save_dir, mmap=mmap)
         
         # Create a SimSearch object.
         ssearch = SimSearch(ksearch)
         
-        # Load the LSI index.
-        ssearch.index = similarities.MatrixSimilarity.load(save_dir + 'index.mm')
+        if mmap is not None:
+            ssearch.mmap_dir = save_dir
+        
+        # Check which type of index the corpus was saved with.
+        if exists(save_dir + 'index-type.pickle'):
+            ssearch.index_type = pickle.load(open(save_dir + 'index-type.pickle', 'rb'))
+        
+        # Load the LSI index. (The worker processes of a sharded index always
+        # memory-map the shards themselves.)
+        if ssearch.index_type == 'sharded':
+            ssearch.index = None
+            ssearch.ann_index = ShardedIndex.load(save_dir, mmap=mmap)
+        else:
+            ssearch.index = similarities.MatrixSimilarity.load(save_dir + 'index.mm', mmap=mmap)
         
         # Load the LSI model.
-        ssearch.lsi = LsiModel.load(save_dir + 'lsi.model')
+        ssearch.lsi = LsiModel.load(save_dir + 'lsi.model', mmap=mmap)
+        
+        # Load the tag centroids. If they weren't saved with this corpus, 
+        # calculate them now.
+        if exists(save_dir + 'tag-centroids.pickle'):
+            ssearch.tag_centroids = pickle.load(open(save_dir + 'tag-centroids.pickle', 'rb'))
+        else:
+            ssearch.buildTagCentroids()
+        
+        # Load the nearest neighbor table, if there is one.
+        if exists(save_dir + 'neighbors.npy'):
+            ssearch.neighbors = np.load(save_dir + 'neighbors.npy', mmap_mode=mmap)
+        
+        # Load the approximate index, if the corpus was saved with one.
+        if ssearch.index_type == 'ivf':
+            ssearch.ann_index = IVFIndex.load(save_dir + 'ivf.index', ssearch.index.index, mmap=mmap)
+        elif ssearch.index_type in ['int8', 'float16']:
+            ssearch.ann_index = QuantizedIndex.load(save_dir + 'quantized.index', ssearch.index.index, mmap=mmap)
         
         return (ksearch, ssearch)
         
\ No newline at end of file
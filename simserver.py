@@ -0,0 +1,267 @@
+# -*- coding: utf-8 -*-
+"""
+A long-running query server for SimSearch and KeySearch.
+
+The server loads the saved corpus once, and then answers queries over a local
+HTTP/JSON interface, so that each query doesn't pay the cost of loading the
+models. Usage:
+
+    python simserver.py --save_dir ./mhc_corpus/ --port 8000 --workers 4
+
+Requests (all GET, results are returned as JSON):
+
+    /text?q=<query text>&topn=10        SimSearch.findSimilarToText
+    /text?q=<text>&include=a&exclude=b  SimSearch.findSimilarWithKeywords
+    /doc?doc_id=73&topn=10              SimSearch.findSimilarToDoc
+    /keyword?include=a,b&exclude=c      KeySearch.keywordSearch
+    /stats                              Corpus size, throughput and latency
+
+The corpus is loaded memory-mapped, and then a pool of worker processes is
+forked which all accept connections on the same listening socket. Since the
+large arrays are memory-mapped read-only, all of the workers share a single
+copy of them through the OS page cache. (Forking the workers requires a
+POSIX system.)
+
+@author: Chris McCormick
+"""
+
+import argparse
+import json
+import os
+import signal
+import time
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from multiprocessing import Array, Lock
+from urlparse import urlparse, parse_qs
+
+from simsearch import SimSearch
+
+
+# The request types which are counted separately in the statistics.
+ENDPOINTS = ['text', 'doc', 'keyword']
+
+# Upper edges (in milliseconds) of the latency histogram buckets. Each bucket
+# is 25% wider than the last, from 0.1ms up to ~30 seconds.
+LATENCY_BUCKETS = [0.1 * (1.25 ** i) for i in range(0, 58)]
+
+
+class ServerStats(object):
+    """
+    Throughput and latency counters, held in shared memory so that they are
+    updated by all of the worker processes.
+    """
+    def __init__(self):
+        self.start_time = time.time()
+        self.lock = Lock()
+
+        # Number of requests, errors, and total latency for each endpoint.
+        self.counts = Array('l', len(ENDPOINTS), lock=False)
+        self.errors = Array('l', len(ENDPOINTS), lock=False)
+        self.latency_sums = Array('d', len(ENDPOINTS), lock=False)
+
+        # Histogram of latencies across all endpoints, with one extra bucket
+        # for anything over the last edge.
+        self.latency_hist = Array('l', len(LATENCY_BUCKETS) + 1, lock=False)
+
+    def record(self, endpoint, latency_ms, error=False):
+        """
+        Record a single request.
+        """
+        i = ENDPOINTS.index(endpoint)
+
+        # Find the histogram bucket for this latency.
+        bucket = 0
+        while (bucket < len(LATENCY_BUCKETS)) and (latency_ms > LATENCY_BUCKETS[bucket]):
+            bucket += 1
+
+        with self.lock:
+            self.counts[i] += 1
+            self.latency_sums[i] += latency_ms
+            self.latency_hist[bucket] += 1
+
+            if error:
+                self.errors[i] += 1
+
+    def getPercentile(self, hist, percent):
+        """
+        Estimate a latency percentile from the histogram, as the upper edge
+        of the bucket which contains it.
+        """
+        total = sum(hist)
+        if total == 0:
+            return 0.0
+
+        count = 0
+        for bucket in range(0, len(hist)):
+            count += hist[bucket]
+
+            if count >= (percent / 100.0) * total:
+                break
+
+        return LATENCY_BUCKETS[min(bucket, len(LATENCY_BUCKETS) - 1)]
+
+    def getStats(self):
+        """
+        Returns a dictionary of the current statistics.
+        """
+        with self.lock:
+            counts = list(self.counts)
+            errors = list(self.errors)
+            latency_sums = list(self.latency_sums)
+            hist = list(self.latency_hist)
+
+        uptime = time.time() - self.start_time
+
+        stats = {'uptime_sec': uptime,
+                 'requests': sum(counts),
+                 'qps': sum(counts) / uptime,
+                 'p50_ms': self.getPercentile(hist, 50),
+                 'p99_ms': self.getPercentile(hist, 99),
+                 'endpoints': {}}
+
+        for i in range(0, len(ENDPOINTS)):
+            mean_ms = 0.0
+            if counts[i] > 0:
+                mean_ms = latency_sums[i] / counts[i]
+
+            stats['endpoints'][ENDPOINTS[i]] = {'requests': counts[i],
+                                                'errors': errors[i],
+                                                'mean_ms': mean_ms}
+
+        return stats
+
+
+class QueryHandler(BaseHTTPRequestHandler):
+    """
+    Handles a single HTTP request. The loaded KeySearch and SimSearch objects
+    and the statistics are found on `self.server`.
+    """
+    def do_GET(self):
+        url = urlparse(self.path)
+        endpoint = url.path.strip('/')
+        params = parse_qs(url.query)
+
+        if endpoint == 'stats':
+            stats = self.server.stats.getStats()
+            
+            # Include the size of the corpus, so that clients (such as 
+            # runLoadTest.py) know the range of valid doc ids.
+            stats['num_docs'] = self.server.ssearch.getNumDocs()
+            
+            self.sendJSON(200, stats)
+            return
+
+        if endpoint not in ENDPOINTS:
+            self.sendJSON(404, {'error': 'Unknown request: ' + url.path})
+            return
+
+        t0 = time.time()
+        error = False
+
+        try:
+            response = self.runQuery(endpoint, params)
+            code = 200
+        except Exception as e:
+            response = {'error': str(e)}
+            code = 400
+            error = True
+
+        self.server.stats.record(endpoint, (time.time() - t0) * 1000.0, error)
+
+        self.sendJSON(code, response)
+
+    def runQuery(self, endpoint, params):
+        """
+        Run the query, and return the response as a dictionary.
+        """
+        ksearch = self.server.ksearch
+        ssearch = self.server.ssearch
+
+        topn = int(params.get('topn', ['10'])[0])
+
+        includes = [w for w in params.get('include', [''])[0].split(',') if w]
+        excludes = [w for w in params.get('exclude', [''])[0].split(',') if w]
+
+        if endpoint == 'text':
+            if includes or excludes:
+                results = ssearch.findSimilarWithKeywords(params['q'][0], includes, excludes,
+                                                          topn=topn)
+            else:
+                results = ssearch.findSimilarToText(params['q'][0], topn=topn)
+        elif endpoint == 'doc':
+            results = ssearch.findSimilarToDoc(int(params['doc_id'][0]), topn=topn)
+        elif endpoint == 'keyword':
+            doc_ids = ksearch.keywordSearch(includes=includes, excludes=excludes)
+
+            return {'num_results': len(doc_ids),
+                    'results': [{'doc_id': doc_id, 'title': ksearch.titles[doc_id]}
+                                for doc_id in doc_ids[0:topn]]}
+
+        return {'results': [{'doc_id': doc_id, 'score': float(score),
+                             'title': ksearch.titles[doc_id]}
+                            for (doc_id, score) in results]}
+
+    def sendJSON(self, code, response):
+        body = json.dumps(response)
+
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Don't print a line for every request.
+        pass
+
+
+def runServer(save_dir='./mhc_corpus/', host='127.0.0.1', port=8000, num_workers=4):
+    """
+    Load the corpus, then serve queries with `num_workers` worker processes.
+    """
+    print('Loading the saved SimSearch and corpus...')
+    (ksearch, ssearch) = SimSearch.load(save_dir=save_dir, mmap='r')
+
+    # Create the listening socket before forking, so that all of the workers
+    # accept connections on it.
+    server = HTTPServer((host, port), QueryHandler)
+    server.ksearch = ksearch
+    server.ssearch = ssearch
+    server.stats = ServerStats()
+
+    print('Serving on http://%s:%d/ with %d workers...' % (host, port, num_workers))
+
+    children = []
+    for i in range(0, num_workers):
+        pid = os.fork()
+
+        # The worker processes just serve requests until they're killed.
+        if pid == 0:
+            try:
+                server.serve_forever()
+            finally:
+                os._exit(0)
+
+        children.append(pid)
+
+    # Wait until interrupted, then shut down the workers.
+    try:
+        for pid in children:
+            os.waitpid(pid, 0)
+    except KeyboardInterrupt:
+        print('Shutting down...')
+        for pid in children:
+            os.kill(pid, signal.SIGTERM)
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='SimSearch query server')
+    parser.add_argument('--save_dir', default='./mhc_corpus/')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--workers', type=int, default=4)
+    args = parser.parse_args()
+
+    runServer(args.save_dir, args.host, args.port, args.workers)
@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+"""
+This module provides the tokenizers which can be used to split text into
+words, both when building the corpus and when processing query text.
+
+The tokenizer is selected by name, and the name is saved with the KeySearch
+so that queries are always tokenized the same way as the corpus was.
+"""
+
+import re
+import nltk
+
+
+# The pattern for the 'regex' tokenizer. This is meant to split text the same
+# way as NLTK's word_tokenize in most cases, but with a single compiled regex:
+#   - Contractions are split like NLTK does, "don't" -> "do", "n't"
+#   - Possessives and other clitics are split off, "god's" -> "god", "'s"
+#   - Words may contain hyphens, periods, and commas between letters or
+#     digits, as in "well-known", "e.g" or "1,000".
+#   - Ellipses and double dashes are single tokens.
+#   - Any other punctuation character is a token by itself.
+TOKEN_PATTERN = re.compile(r"""
+      \w+(?=n't\b)
+    | n't\b
+    | '(?:s|m|d|ll|re|ve)\b
+    | \w+(?:[-.,]\w+)*
+    | \.\.\.
+    | --
+    | \S
+    """, re.UNICODE | re.VERBOSE)
+
+
+def nltkTokenize(text):
+    """
+    Tokenize `text` with NLTK's word_tokenize. This is the most accurate, but
+    also the slowest, tokenizer.
+    """
+    return nltk.word_tokenize(text)
+
+
+def regexTokenize(text):
+    """
+    Tokenize `text` with a single compiled regular expression, TOKEN_PATTERN.
+    This is many times faster than NLTK, and agrees with it on almost all
+    tokens (see runTokenizerParity.py).
+    """
+    return TOKEN_PATTERN.findall(text)
+
+
+# The available tokenizers, by name.
+TOKENIZERS = {'nltk': nltkTokenize,
+              'regex': regexTokenize}
+
+
+def getTokenizer(name):
+    """
+    Returns the tokenizer function with the given `name`.
+    """
+    if name not in TOKENIZERS:
+        raise ValueError('Unknown tokenizer \'%s\', must be one of: %s' %
+                         (name, ', '.join(sorted(TOKENIZERS.keys()))))
+
+    return TOKENIZERS[name]